@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Benchmark of the closure of the DependencyGraph of doc_depgen.
+
+Builds in memory a deep include chain (the worst case of a closure memoized
+for each file), with a cycle at its end and a few documents sharing it,
+then times the closure of the documents.
+Only the graph is measured, the file system is not accessed.
+
+Usage: [NODES] [REPEAT]
+"""
+
+import os.path
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'script'))
+import doc_depgen
+
+DOCUMENTS = 4
+CYCLE = 10
+
+def generate_graph(count):
+	"""Generates a chain of count files included by DOCUMENTS documents.
+
+	The last CYCLE files of the chain are a cycle.
+	Returns (graph, documents).
+	"""
+	graph = doc_depgen.DependencyGraph()
+	files = ['input/part%d.tex' % i for i in range(count)]
+	for parent, child in zip(files, files[1:]):
+		graph.add_edge(parent, child, 'tex')
+	graph.add_edge(files[-1], files[-CYCLE], 'tex')
+	documents = ['document%d.tex' % i for i in range(DOCUMENTS)]
+	for document in documents:
+		graph.add_edge(document, files[0], 'tex')
+	return graph, documents
+
+def closures(graph, documents):
+	"""Computes the closure of each document (without memoization)."""
+	graph._closure = {}
+	return [graph.closure(document) for document in documents]
+
+def main():
+	"""The main program."""
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+	graph, documents = generate_graph(count)
+	# check the results: the whole chain, a file of the cycle reaches itself
+	for reach in closures(graph, documents):
+		assert len(reach) == count, len(reach)
+	cycle = 'input/part%d.tex' % (count - 1)
+	assert cycle in graph.closure(cycle)
+	assert documents[0] not in graph.closure(documents[0])
+	best = min(timeit.repeat(lambda: closures(graph, documents),
+		number=1, repeat=repeat))
+	tracemalloc.start()
+	closures(graph, documents)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	print("nodes: %d, documents: %d" % (count + DOCUMENTS, DOCUMENTS))
+	print("closure: %.4fs (%.0f nodes/s)" % (best, DOCUMENTS * count / best))
+	print("peak memory: %.1f MB" % (peak / 1e6))
+
+if __name__ == '__main__':
+	main()
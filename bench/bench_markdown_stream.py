@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Benchmark of markdown_stream.copy_markdown.
+
+Compares the throughput (MB/s) of the block copy with the previous
+implementation which searched and wrote each line separately.
+A generated book is written in a temporary directory.
+
+Usage: [LINES] [REPEAT]
+"""
+
+import io
+import os
+import os.path
+import re
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'script'))
+import markdown_stream
+
+# ---------------------------------------------------------
+# Previous implementation: re.search and write for each line
+
+def legacy_copy_markdown(out, filename,
+		copy_header=False,
+		recursion=None,
+		err=sys.stderr):
+	"""Copies the markdown file to the output stream."""
+	err.write("Reading markdown: %s\n" % filename)
+	if recursion is None:
+		recursion = LEGACY_RECURSION_FUNCTIONS
+	with open(filename, 'r') as f:
+		header = len(markdown_stream.HEADER_LINES) if copy_header else None
+		for line in f:
+			if header is not None:
+				if line.strip().startswith('%'):
+					if header > 0: out.write(line)
+					header -= 1
+					continue
+				else:
+					header = None
+			m = re.search(r'!\[[^]]+\]\(([^)]+)(?:\s["\'].*["\'])?\)',
+					line)
+			if m is not None and m.group(1).find("://") < 0:
+				ref = m.group(1)
+				ext = os.path.splitext(ref)[1][1:]
+				if ext in recursion or '' in recursion:
+					out.write(line[:m.start()])
+					recfunc = recursion[ext] if ext in recursion else recursion['']
+					recfunc(out, ref, recursion=recursion, err=err)
+					out.write(line[m.end():])
+					continue
+				else:
+					err.write("Included file (as is): %s\n" % ref)
+			out.write(line)
+
+LEGACY_RECURSION_FUNCTIONS = {e: legacy_copy_markdown
+	for e in markdown_stream.MD_EXT}
+
+# ---------------------------------------------------------
+
+def generate_book(directory, lines):
+	"""Generates a book with chapters, returns the root file."""
+	chapter = os.path.join(directory, 'chapter.md')
+	with open(chapter, 'w') as f:
+		for i in range(lines // 10):
+			f.write('A line of the chapter with *emphasis* number %d.\n' % i)
+	root = os.path.join(directory, 'book.md')
+	with open(root, 'w') as f:
+		f.write('% Title\n% Author\n% Date\n\n')
+		for i in range(lines):
+			if i % 5000 == 0:
+				f.write('![Chapter](%s)\n' % chapter)
+			elif i % 100 == 0:
+				f.write('![An image](img/figure-%d.png)\n' % i)
+			else:
+				f.write('Some text of paragraph %d, with a [link](x).\n' % i)
+	return root
+
+def bench(func, root, repeat):
+	"""Returns the best time and the output size of a copy."""
+	err = io.StringIO()
+	def run():
+		out = io.StringIO()
+		func(out, root, copy_header=True, err=err)
+		return out
+	size = len(run().getvalue())
+	return min(timeit.repeat(run, number=1, repeat=repeat)), size
+
+def main():
+	"""The main program."""
+	lines = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+	repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+	with tempfile.TemporaryDirectory() as directory:
+		root = generate_book(directory, lines)
+		# check that the outputs are the same
+		legacy, current = io.StringIO(), io.StringIO()
+		legacy_copy_markdown(legacy, root, copy_header=True,
+			err=io.StringIO())
+		markdown_stream.copy_markdown(current, root, copy_header=True,
+			err=io.StringIO())
+		assert legacy.getvalue() == current.getvalue()
+		legacy, size = bench(legacy_copy_markdown, root, repeat)
+		current, _ = bench(markdown_stream.copy_markdown, root, repeat)
+	mb = size / 1e6
+	print("lines: %d (%.1f MB)" % (lines, mb))
+	print("legacy:  %.4fs (%.1f MB/s)" % (legacy, mb / legacy))
+	print("current: %.4fs (%.1f MB/s)" % (current, mb / current))
+	print("speedup: %.2fx" % (legacy / current))
+
+if __name__ == '__main__':
+	main()
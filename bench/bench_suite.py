@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Benchmark suite of the scripts on a generated corpus (see corpus.py).
+
+Times, at several scales, in a temporary directory:
+- doc_depgen.find_dependencies and doc_depgen.main
+- markdown_stream.copy_markdown and markdown_stream.execute
+- latex_base_clone.update_files (copy and update without changes)
+
+The best time of each benchmark is written as JSON, so that the results
+of two revisions can be compared with --compare.
+
+Usage: [--scales 1,10] [--repeat n] [--output file] [--compare file]
+"""
+
+import contextlib
+import io
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'script'))
+import corpus
+import doc_depgen
+import latex_base_clone
+import markdown_stream
+
+def best_time(func, repeat, setup=None):
+	"""Returns the best time of func (setup is called before each run)."""
+	best = None
+	for _ in range(repeat):
+		if setup is not None:
+			setup()
+		start = time.perf_counter()
+		func()
+		duration = time.perf_counter() - start
+		if best is None or duration < best:
+			best = duration
+	return best
+
+# ---------------------------------------------------------
+
+def bench_depgen(roots, repeat):
+	"""Times the dependency generation of the LaTeX roots."""
+	def find():
+		index = doc_depgen.FileIndex()
+		for root in roots:
+			doc_depgen.find_dependencies(root, index=index)
+	def main():
+		argv = sys.argv
+		sys.argv = ['doc_depgen.py'] + roots
+		try:
+			with contextlib.redirect_stdout(io.StringIO()):
+				doc_depgen.main()
+		finally:
+			sys.argv = argv
+	return {
+		'depgen.find_dependencies': best_time(find, repeat),
+		'depgen.main': best_time(main, repeat),
+	}
+
+def bench_markdown(root, repeat):
+	"""Times the copy of the markdown book."""
+	err = io.StringIO()
+	def copy():
+		markdown_stream.copy_markdown(io.StringIO(), root, copy_header=True,
+			err=err)
+	def execute():
+		cache = markdown_stream.FragmentCache(
+			markdown_stream.FRAGMENT_CACHE_SIZE)
+		markdown_stream.execute([root, root], out=io.StringIO(), err=err,
+			recursion=markdown_stream.cached_recursion(cache))
+	return {
+		'markdown.copy_markdown': best_time(copy, repeat),
+		'markdown.execute': best_time(execute, repeat),
+	}
+
+def bench_clone(src, dest, repeat):
+	"""Times the copy and the update of a latex-base directory."""
+	def clean():
+		shutil.rmtree(dest, ignore_errors=True)
+		os.mkdir(dest)
+	def update():
+		with contextlib.redirect_stdout(io.StringIO()):
+			latex_base_clone.update_files(dest, src,
+				manifest=latex_base_clone.HashManifest(dest),
+				policy='overwrite')
+	results = {'clone.update_files': best_time(update, repeat, setup=clean)}
+	update()
+	results['clone.update_files.unchanged'] = best_time(update, repeat)
+	return results
+
+def run_scale(scale, repeat):
+	"""Generates the corpus of a scale and runs the benchmarks."""
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as directory:
+		roots = corpus.generate_tex(directory, scale)
+		book = corpus.generate_markdown(directory, scale)
+		src, dest = corpus.generate_base(directory, scale)
+		# the references are relative to the directory of the documents
+		os.chdir(directory)
+		try:
+			results = {}
+			results.update(bench_depgen(roots, repeat))
+			results.update(bench_markdown(book, repeat))
+			results.update(bench_clone(src, dest, repeat))
+		finally:
+			os.chdir(cwd)
+	return results
+
+# ---------------------------------------------------------
+
+def revision():
+	"""Gets the current git revision (None if unknown)."""
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(results, previous, out=sys.stdout):
+	"""Prints the ratio between the times of two results."""
+	out.write("%-32s %8s %10s %10s %8s\n"
+		% ('benchmark', 'scale', 'previous', 'current', 'ratio'))
+	for scale, times in sorted(results['scales'].items(), key=lambda s: int(s[0])):
+		old_times = previous['scales'].get(scale, {})
+		for name, current in sorted(times.items()):
+			old = old_times.get(name)
+			if old is None: continue
+			out.write("%-32s %8s %10.4f %10.4f %7.2fx\n"
+				% (name, scale, old, current, old / current))
+
+def main():
+	"""The main program."""
+	scales = [1, 10]
+	repeat = 3
+	output = None
+	previous = None
+	args = iter(sys.argv[1:])
+	for arg in args:
+		if arg == '--scales':
+			scales = [int(s) for s in next(args, '1').split(',')]
+		elif arg == '--repeat':
+			repeat = int(next(args, repeat))
+		elif arg == '--output':
+			output = next(args, None)
+		elif arg == '--compare':
+			with open(next(args, None), 'r') as f:
+				previous = json.load(f)
+		else:
+			sys.stderr.write("Unknown argument: %s\n" % arg)
+			sys.exit(1)
+	results = {
+		'revision': revision(),
+		'python': platform.python_version(),
+		'repeat': repeat,
+		'scales': {},
+	}
+	for scale in scales:
+		sys.stderr.write("Scale %d...\n" % scale)
+		results['scales'][str(scale)] = run_scale(scale, repeat)
+	if output is not None:
+		with open(output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+			f.write('\n')
+	if previous is not None:
+		compare(results, previous)
+	else:
+		json.dump(results, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Benchmark of the LaTeX line scanner of doc_depgen.
+
+Compares the single-pass scanner (doc_depgen.scan_tex_line) with the
+previous implementation which searched each command pattern separately.
+Only the scanning is measured, the file system is not accessed.
+
+Usage: [LINES] [REPEAT]
+"""
+
+import os.path
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'script'))
+import doc_depgen
+
+# ---------------------------------------------------------
+# Previous implementation: one re.search per command and per line
+
+def legacy_scan_tex_line(line):
+	"""Returns the references in a line (at most one per command)."""
+	refs = []
+	match_arg = '\\{(.+?)\\}'
+	match_arg_ignore = '\\{.+?\\}'
+	match_opt = '(?:\\[[^\\]]*\\])?'
+	match_opt_arg = match_opt + match_arg
+	for regex in [
+			'\\\\documentclass' + match_opt_arg,
+			'\\\\usepackage' + match_opt_arg,
+			'\\\\(?:input|include)' + match_arg,
+			'\\\\bibliography' + match_arg,
+			'\\\\includegraphics' + match_opt_arg,
+			'\\\\includeimage(?:base|figure)?'
+				+ '(?:' + match_opt + ')*' + match_arg,
+			'\\\\pgfdeclareimage' + match_opt
+				+ match_arg_ignore + match_arg,
+			'\\\\inputminted' + match_arg_ignore + match_arg,
+			'\\\\lstinputlisting' + match_opt_arg]:
+		m = re.search(regex, line)
+		if m is None: continue
+		f = m.group(1)
+		if f == '' or re.match('.*#\\d+.*|.*\\\\.*', f) is not None:
+			continue
+		refs.append(f)
+	return refs
+
+def current_scan_tex_line(line):
+	"""Returns the references in a line."""
+	return [ref for _, ref in doc_depgen.scan_tex_line(line)]
+
+# ---------------------------------------------------------
+
+SAMPLE_LINES = [
+	'Some text of a paragraph without any command, only words.',
+	'Text with \\emph{emphasis} and \\textbf{bold} and a formula $x^2$.',
+	'\\input{chapter/introduction}',
+	'\\usepackage[utf8]{inputenc}',
+	'\\includegraphics[width=\\linewidth]{img/figure}'
+		+ ' \\includegraphics{img/other}',
+	'\\includeimagefigure[width=3cm][H][Logo]{logo}{Caption}',
+	'\\lstinputlisting[language=Python]{code/example.py}',
+	'\\begin{itemize} \\item one \\item two \\end{itemize}',
+]
+
+def generate_lines(count):
+	"""Generates a list of LaTeX lines."""
+	return [SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(count)]
+
+def bench(func, lines, repeat):
+	"""Returns the best time to scan all lines."""
+	return min(timeit.repeat(lambda: [func(l) for l in lines],
+		number=1, repeat=repeat))
+
+def main():
+	"""The main program."""
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+	lines = generate_lines(count)
+	# check that the results are compatible
+	for line in SAMPLE_LINES:
+		legacy = legacy_scan_tex_line(line)
+		current = current_scan_tex_line(line)
+		assert set(legacy) <= set(current), line
+	legacy = bench(legacy_scan_tex_line, lines, repeat)
+	current = bench(current_scan_tex_line, lines, repeat)
+	print("lines: %d" % count)
+	print("legacy:  %.4fs (%.0f lines/s)" % (legacy, count / legacy))
+	print("current: %.4fs (%.0f lines/s)" % (current, count / current))
+	print("speedup: %.2fx" % (legacy / current))
+
+if __name__ == '__main__':
+	main()
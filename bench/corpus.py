@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Generator of synthetic documents for the benchmarks.
+
+- LaTeX: deep (chained) and wide \\input trees, chapters with many figures
+  and long comment blocks
+- markdown: books with nested ![..](x.md) includes
+- latex-base: a source and a destination for latex_base_clone
+
+Nothing is compiled, so neither TeX, pandoc nor Java are needed.
+
+Usage: directory [scale]
+"""
+
+import os
+import os.path
+import sys
+
+def write(path, lines):
+	"""Writes lines to a file, creating the directory."""
+	directory = os.path.dirname(path)
+	if directory:
+		os.makedirs(directory, exist_ok=True)
+	with open(path, 'w') as f:
+		for line in lines:
+			f.write(line + '\n')
+
+def paragraph(i, words=12):
+	"""Gets a line of text."""
+	return ' '.join('word%d' % ((i + j) % 97) for j in range(words))
+
+def tex_chapter(name, index, lines, figures, comments):
+	"""Gets the lines of a chapter."""
+	yield '\\section{Chapter %d}' % index
+	for i in range(lines):
+		if figures and i % (lines // figures or 1) == 0:
+			yield ('\\includegraphics[width=\\linewidth]{img/%s-fig%d}'
+				% (name, i))
+		elif comments and i % 50 == 0:
+			# a long comment block, joined with the next line
+			for j in range(comments):
+				yield '%% comment %d of the block: %s' % (j, paragraph(j, 6))
+			yield 'Text after the comment with \\emph{emphasis} %d.' % i
+		else:
+			yield 'Text %s \\textbf{bold} %d.' % (paragraph(i), i)
+
+def generate_tex(directory, scale=1):
+	"""Generates LaTeX documents, returns the list of root files.
+
+	- wide.tex inputs 10 * scale chapters with figures and comments
+	- deep.tex is a chain of 10 * scale inputs
+	"""
+	count = 10 * scale
+	# wide tree
+	chapters = []
+	for i in range(count):
+		name = 'wide/chapter%d' % i
+		write(os.path.join(directory, name + '.tex'),
+			tex_chapter('c%d' % i, i, lines=200, figures=20, comments=20))
+		chapters.append('\\input{%s}' % name)
+	for i in range(count):
+		# half of the figures exist
+		for j in range(0, 200, 20):
+			if j % 40 == 0:
+				write(os.path.join(directory, 'img', 'c%d-fig%d.pdf' % (i, j)),
+					['%PDF'])
+	write(os.path.join(directory, 'wide.tex'), [
+		'\\documentclass{article}',
+		'\\usepackage{graphicx}',
+		'\\usepackage[utf8]{inputenc}',
+		'\\begin{document}',
+	] + chapters + [
+		'\\bibliography{refs}',
+		'\\end{document}',
+	])
+	write(os.path.join(directory, 'refs.bib'), ['@book{a, title={A}}'])
+	# deep tree
+	for i in range(count):
+		next_input = (['\\input{deep/part%d}' % (i + 1)]
+			if i + 1 < count else [])
+		write(os.path.join(directory, 'deep', 'part%d.tex' % i),
+			list(tex_chapter('d%d' % i, i, lines=50, figures=2, comments=0))
+			+ next_input)
+	write(os.path.join(directory, 'deep.tex'), [
+		'\\documentclass{article}',
+		'\\begin{document}',
+		'\\input{deep/part0}',
+		'\\end{document}',
+	])
+	return ['wide.tex', 'deep.tex']
+
+def generate_markdown(directory, scale=1):
+	"""Generates a markdown book, returns the root file.
+
+	The book includes 10 * scale chapters, each including 3 sections.
+	"""
+	chapters = []
+	for i in range(10 * scale):
+		sections = []
+		for j in range(3):
+			name = 'md/chapter%d-section%d.md' % (i, j)
+			write(os.path.join(directory, name), [
+				'![Figure](img/figure-%d-%d.png)' % (i, j) if k % 25 == 0
+				else 'Text %s *emphasis* %d.' % (paragraph(k), k)
+				for k in range(100)])
+			sections.append('![Section](%s)' % name)
+		name = 'md/chapter%d.md' % i
+		write(os.path.join(directory, name),
+			['# Chapter %d' % i, ''] + sections)
+		chapters.append('![Chapter](%s)' % name)
+	write(os.path.join(directory, 'book.md'), [
+		'% Title', '% Author', '% Date', '',
+	] + chapters)
+	return 'book.md'
+
+def generate_base(directory, scale=1):
+	"""Generates a latex-base directory, returns (source, destination).
+
+	The source contains 20 * scale files in script and input; the
+	destination is created by the benchmark.
+	"""
+	src = os.path.join(directory, 'base')
+	write(os.path.join(src, 'Makefile'), ['all:'])
+	write(os.path.join(src, 'Makefile.files'), ['# files'])
+	for name in ['.gitignore', '.hgignore']:
+		write(os.path.join(src, name), ['*.pdf'])
+	for i in range(20 * scale):
+		sub = 'script' if i % 2 == 0 else 'input'
+		write(os.path.join(src, sub, 'dir%d' % (i % 5), 'file%d.txt' % i),
+			[paragraph(k) for k in range(100)])
+	return src, os.path.join(directory, 'clone')
+
+def main():
+	"""The main program."""
+	if len(sys.argv) < 2:
+		sys.stderr.write("Usage: directory [scale]\n")
+		sys.exit(1)
+	directory = sys.argv[1]
+	scale = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+	print(' '.join(generate_tex(directory, scale)))
+	print(generate_markdown(directory, scale))
+	print(generate_base(directory, scale)[0])
+
+if __name__ == '__main__':
+	main()
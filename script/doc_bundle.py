@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Writes documents and the files they depend on (see doc_depgen) into a tar
+or zip archive, e.g. to build them on another machine:
+
+- the files are streamed into the archive by blocks (no staging copy)
+- the archive is deterministic: sorted entries, fixed dates and owners
+- in a tar archive, identical files are stored once, the others are hard
+  links to the first one (a zip archive stores them all, as the symbolic
+  links of zip files are not portable)
+- the generated images are added with their sources (see img_build)
+"""
+
+import collections
+import gzip
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tarfile
+import zipfile
+
+import doc_depgen
+import img_build
+
+BLOCK_SIZE = 1 << 16
+# date of the entries (the earliest one a zip file can store)
+ARCHIVE_DATE = (1980, 1, 1, 0, 0, 0)
+ARCHIVE_MTIME = 315532800
+# Archive formats by suffix of the file name
+ARCHIVE_FORMATS = [
+	('.tar.gz', 'tgz'),
+	('.tgz', 'tgz'),
+	('.tar.bz2', 'tbz2'),
+	('.tar.xz', 'txz'),
+	('.tar', 'tar'),
+	('.zip', 'zip'),
+]
+TAR_MODES = {'tar': 'w|', 'tbz2': 'w|bz2', 'txz': 'w|xz'}
+
+def archive_format(filename):
+	"""Gets the format of an archive from its name (None if unknown)."""
+	for suffix, fmt in ARCHIVE_FORMATS:
+		if filename.endswith(suffix):
+			return fmt
+	return None
+
+def image_sources(path):
+	"""Gets the existing sources from which an image is generated."""
+	base = os.path.splitext(path)[0]
+	return [base + '.' + ext for ext in sorted(img_build.CONVERSIONS)
+		if os.path.isfile(base + '.' + ext)
+		and img_build.image_steps(base + '.' + ext)[-1][1] == path]
+
+def bundle_files(documents, cache=None, index=None, use_fls=False,
+		err=sys.stderr):
+	"""Lists the files of the documents and of their dependencies (sorted).
+
+	The files outside of the current directory and the missing files
+	which are not generated from a source are ignored.
+	"""
+	if index is None:
+		index = doc_depgen.FileIndex()
+	find = lambda path: doc_depgen.find_dependencies(path, cache=cache,
+		index=index)
+	if use_fls:
+		find = doc_depgen.merge_recorded(find, index)
+	files = set()
+	for document in documents:
+		deps = find(document)
+		if deps is None:
+			err.write("No dependencies for %s\n" % document)
+			deps = set()
+		for path in set(deps) | set([document]):
+			path = doc_depgen.project_path(path)
+			if path is None:
+				continue
+			sources = image_sources(path)
+			if os.path.isfile(path):
+				files.add(path)
+			elif not sources:
+				err.write("Missing: %s\n" % path)
+			files.update(sources)
+	return sorted(files)
+
+def find_duplicates(files):
+	"""Maps the files identical to a previous one (in order) to the latter.
+
+	Only the non-empty files having the same size are hashed.
+	"""
+	by_size = collections.defaultdict(list)
+	for path in files:
+		by_size[os.path.getsize(path)].append(path)
+	duplicates = {}
+	for size, paths in by_size.items():
+		if size == 0 or len(paths) < 2: continue
+		first = {}
+		for path in paths:
+			digest = img_build.hash_file(path)
+			if digest in first:
+				duplicates[path] = first[digest]
+			else:
+				first[digest] = path
+	return duplicates
+
+def file_mode(path):
+	"""Gets the normalized permissions of a file."""
+	return 0o755 if os.stat(path).st_mode & 0o111 else 0o644
+
+# =========================================================
+
+def write_tar(tar, files, duplicates, prefix=''):
+	"""Adds the files to a tar archive (duplicates as hard links)."""
+	for path in files:
+		info = tarfile.TarInfo(prefix + path)
+		info.mtime = ARCHIVE_MTIME
+		info.uid = info.gid = 0
+		info.uname = info.gname = ''
+		info.mode = file_mode(path)
+		if path in duplicates:
+			info.type = tarfile.LNKTYPE
+			info.linkname = prefix + duplicates[path]
+			tar.addfile(info)
+			continue
+		with open(path, 'rb') as f:
+			info.size = os.fstat(f.fileno()).st_size
+			tar.addfile(info, f)
+
+def write_zip(archive, files, prefix=''):
+	"""Adds the files to a zip archive."""
+	for path in files:
+		info = zipfile.ZipInfo(prefix + path, date_time=ARCHIVE_DATE)
+		info.create_system = 3 # unix permissions
+		info.compress_type = zipfile.ZIP_DEFLATED
+		info.external_attr = (stat.S_IFREG | file_mode(path)) << 16
+		with open(path, 'rb') as f:
+			info.file_size = os.fstat(f.fileno()).st_size
+			with archive.open(info, 'w') as dest:
+				shutil.copyfileobj(f, dest, BLOCK_SIZE)
+
+def write_bundle(out, files, fmt='tar', prefix=''):
+	"""Streams the files into an archive written to out (a binary file).
+
+	Returns the map of the duplicates stored as links (see find_duplicates).
+	"""
+	if fmt == 'zip':
+		with zipfile.ZipFile(out, 'w') as archive:
+			write_zip(archive, files, prefix)
+		return {}
+	duplicates = find_duplicates(files)
+	compressed = None
+	if fmt == 'tgz':
+		# (no name nor date in the gzip header)
+		out = compressed = gzip.GzipFile(filename='', mode='wb', fileobj=out,
+			mtime=0)
+	try:
+		with tarfile.open(fileobj=out, mode=TAR_MODES.get(fmt, 'w|'),
+				bufsize=BLOCK_SIZE) as tar:
+			write_tar(tar, files, duplicates, prefix)
+	finally:
+		if compressed is not None:
+			compressed.close()
+	return duplicates
+
+def main():
+	"""The main program.
+
+	Usage: [--cache file] [--fls] [--prefix directory] [--format format]
+	       --output file|- documents
+
+	--cache reuses the references stored in a cache file (see doc_depgen)
+	--fls adds the files recorded by pdflatex -recorder (document.fls)
+	--prefix puts the files in a directory of the archive
+	--format sets the format: tar, tgz, tbz2, txz or zip (default: from the
+	name of the output, tar for the standard output)
+	--output writes the archive to a file ("-" for the standard output)
+	"""
+	cache = None
+	use_fls = False
+	prefix = ''
+	fmt = None
+	output = None
+	documents = []
+	args = iter(sys.argv[1:])
+	for arg in args:
+		if arg == '--cache':
+			cache = doc_depgen.DependencyCache(next(args, None))
+		elif arg == '--fls':
+			use_fls = True
+		elif arg == '--prefix':
+			prefix = next(args, '').rstrip('/')
+			if prefix: prefix += '/'
+		elif arg == '--format':
+			fmt = next(args, None)
+		elif arg == '--output':
+			output = next(args, None)
+		else:
+			documents.append(arg)
+	if output is None or not documents:
+		sys.stderr.write("Usage: [--cache file] [--fls] [--prefix directory]"
+			" [--format format] --output file|- documents\n")
+		sys.exit(1)
+	if fmt is None:
+		fmt = archive_format(output) or 'tar'
+	if fmt not in TAR_MODES and fmt not in ['tgz', 'zip']:
+		sys.stderr.write("Unknown format: %s\n" % fmt)
+		sys.exit(1)
+	files = bundle_files(documents, cache=cache, use_fls=use_fls)
+	if cache is not None:
+		cache.save()
+	if output == '-':
+		duplicates = write_bundle(sys.stdout.buffer, files, fmt, prefix)
+	else:
+		tmp = '%s.%d.tmp' % (output, os.getpid())
+		try:
+			with open(tmp, 'wb') as f:
+				duplicates = write_bundle(f, files, fmt, prefix)
+			os.replace(tmp, output)
+		finally:
+			if os.path.exists(tmp):
+				os.remove(tmp)
+	sys.stderr.write("Bundled %d files (%d duplicates) from %d documents\n"
+		% (len(files), len(duplicates), len(documents)))
+
+if __name__ == '__main__':
+	main()
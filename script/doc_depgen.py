@@ -4,11 +4,22 @@ Quick document file dependency generator:
 
 - parses LaTeX files
 - parses markdown
+- reads the files recorded by pdflatex -recorder (.fls)
 """
 
+import concurrent.futures
+import cProfile
+import fcntl
+import hashlib
+import io
+import json
+import os
 import os.path
 import re
 import sys
+import time
+
+import markdown_stream
 
 GEN_FROM = ['Makefile.files']
 IMG_ROOT_DIR = 'img'
@@ -16,77 +27,110 @@ IMG_EXT_NORMAL = ['eps', 'jpg', 'pdf', 'png']
 IMG_EXT_DEF = 'pdf'
 assert IMG_EXT_DEF in IMG_EXT_NORMAL
 MD_EXT = ['md', 'markdown', 'mkdn', 'mdown']
+# types of references whose content is part of the document
+INCLUDE_TYPES = ['tex', 'markdown']
+# number of include cycles reported for a document
+MAX_REPORTED_CYCLES = 10
+# index of the dependency files written by --split
+DEPFILE_INDEX = 'index'
 
 # =========================================================
 
-def find_tex_dependencies(filename, dep):
-	"""Generates dependencies for a tex file."""
+MATCH_ARG = '\\{(.+?)\\}'
+MATCH_ARG_IGNORE = '\\{.+?\\}'
+MATCH_OPT = '(?:\\[[^\\]]*\\])?'
+MATCH_OPT_ARG = MATCH_OPT + MATCH_ARG
+
+# LaTeX commands referencing files: (type, regex, resolution options)
+# each regex contains exactly one group which is the referenced file
+TEX_COMMANDS = [
+	# document class
+	('cls', '\\\\documentclass' + MATCH_OPT_ARG,
+		{'ext': 'cls', 'optional': True}),
+	# style files
+	('sty', '\\\\usepackage' + MATCH_OPT_ARG,
+		{'ext': 'sty', 'optional': True}),
+	# include | input
+	('tex', '\\\\(?:input|include)' + MATCH_ARG,
+		{'ext': 'tex'}),
+	# bibliography
+	('bib', '\\\\bibliography' + MATCH_ARG,
+		{'ext': 'bib'}),
+	# includegraphics
+	('image', '\\\\includegraphics' + MATCH_OPT_ARG,
+		{'ext': IMG_EXT_NORMAL, 'extdef': IMG_EXT_DEF}),
+	# includeimage | includeimagefigure
+	('image', '\\\\includeimage(?:base|figure)?'
+		+ '(?:' + MATCH_OPT + ')*' + MATCH_ARG,
+		{'ext': IMG_EXT_NORMAL, 'extdef': IMG_EXT_DEF,
+			'directory': IMG_ROOT_DIR}),
+	# pgfdeclareimage
+	('image', '\\\\pgfdeclareimage' + MATCH_OPT + MATCH_ARG_IGNORE + MATCH_ARG,
+		{'ext': IMG_EXT_NORMAL, 'extdef': IMG_EXT_DEF}),
+	# inputminted
+	('listing', '\\\\inputminted' + MATCH_ARG_IGNORE + MATCH_ARG,
+		{}),
+	# lstinputlisting
+	('listing', '\\\\lstinputlisting' + MATCH_OPT_ARG,
+		{}),
+]
+# all the commands in a single pass (the n-th group is the n-th command)
+TEX_COMMANDS_REGEX = re.compile('|'.join(
+	'(?:%s)' % regex for _, regex, _ in TEX_COMMANDS))
+# references that are not file names (macro arguments or commands)
+TEX_INVALID_REGEX = re.compile('#\\d|\\\\')
+# inline verbatim text (e.g. \verb|\input{x}|) which is not scanned
+TEX_VERBATIM_REGEX = re.compile(
+	'\\\\(?:verb\\*?|lstinline(?:\\[[^\\]]*\\])?)([^\\sa-zA-Z{]).*?\\1')
+
+def find_tex_dependencies(filename, cache = None, index = None,
+		stats = None):
+	"""Gets the direct dependencies of a tex file as (path, type)."""
 	# check the arguments
 	if os.path.splitext(filename)[1] != '.tex':
 		sys.stderr.write("find_tex_dependencies(%s): works only for tex files\n"
 			% filename)
-		return dep
-	if not os.path.isfile(filename):
+		return []
+	if index is None:
+		index = FileIndex()
+	if not index.isfile(filename):
 		sys.stderr.write("find_tex_dependencies(%s): file does not exist\n"
 			% filename)
-		return dep
-	# analyse the lines of the given file
+		return []
+	# resolve the references of the given file
+	refs = read_references(filename, scan_tex_file, cache, stats)
+	return resolve_references(filename, refs, index, stats)
+
+def scan_tex_file(filename, info = None):
+	"""Returns the references of a tex file as [command index, reference].
+
+	info: a dict receiving the number of bytes and of logical lines read
+	"""
+	refs = []
+	lines = 0
 	with open(filename, 'r') as f:
-		match_arg = '\\{(.+?)\\}'
-		match_arg_ignore = '\\{.+?\\}'
-		match_opt = '(?:\\[[^\\]]*\\])?'
-		match_opt_arg = match_opt + match_arg
 		for line in latex_lines(f):
-			if line == '': continue
-			# -------------------------------
-			# document class
-			match_tex_dependency(dep, line,
-				'\\\\documentclass' + match_opt_arg, ext = 'cls',
-				optional = True)
-			# style files
-			match_tex_dependency(dep, line,
-				'\\\\usepackage'+match_opt_arg, ext = 'sty',
-				optional = True)
-			# include | input
-			match_tex_dependency(dep, line,
-				'\\\\(?:input|include)' + match_arg, ext = 'tex')
-			# bibliography
-			match_tex_dependency(dep, line,
-				'\\\\bibliography' + match_arg, ext = 'bib')
-			# includegraphics
-			match_tex_dependency(dep, line,
-				'\\\\includegraphics' + match_opt_arg,
-				ext = IMG_EXT_NORMAL, extdef = IMG_EXT_DEF)
-			# includeimage | includeimagefigure
-			match_tex_dependency(dep, line,
-				'\\\\includeimage(?:base|figure)?'
-				+ '(?:' + match_opt + ')*' + match_arg,
-				ext = IMG_EXT_NORMAL, extdef = IMG_EXT_DEF,
-				directory = IMG_ROOT_DIR)
-			# pgfdeclareimage
-			match_tex_dependency(dep, line,
-				'\\\\pgfdeclareimage' + match_opt
-					+ match_arg_ignore + match_arg,
-				ext = IMG_EXT_NORMAL, extdef = IMG_EXT_DEF)
-			# inputminted
-			match_tex_dependency(dep, line,
-				'\\\\inputminted' + match_arg_ignore + match_arg)
-			# lstinputlisting
-			match_tex_dependency(dep, line,
-				'\\\\lstinputlisting' + match_opt_arg)
-			# -------------------------------
-
-def match_tex_dependency(dep, line, regex,
-		ext = '', extdef = '', directory = '',
-		invalid = '.*#\\d+.*|.*\\\\.*', optional = False):
-	"""Tries to match a dependency on a tex file line."""
-	# find
-	m = re.search(regex, line)
-	if m is None: return
-	f = m.group(1)
-	if (f == '' or (
-		invalid is not None and
-		re.match(invalid, f) is not None)): return
+			lines += 1
+			refs.extend([index, ref] for index, ref in scan_tex_line(line))
+		if info is not None:
+			info['bytes'] = os.fstat(f.fileno()).st_size
+			info['lines'] = lines
+	return refs
+
+def scan_tex_line(line):
+	"""Generator of (command index, reference) for each command in a line."""
+	if '\\verb' in line or '\\lstinline' in line:
+		line = TEX_VERBATIM_REGEX.sub('', line)
+	for m in TEX_COMMANDS_REGEX.finditer(line):
+		ref = m.group(m.lastindex)
+		if ref == '' or TEX_INVALID_REGEX.search(ref) is not None: continue
+		yield m.lastindex - 1, ref
+
+def resolve_tex_dependency(f,
+		ext = '', extdef = '', directory = '', optional = False,
+		index = None):
+	"""Finds the file referenced in a tex file (None if not found)."""
+	isfile = os.path.isfile if index is None else index.isfile
 	# add the directory
 	if directory != '': f = os.path.join(directory, f)
 	# check the extension
@@ -96,63 +140,452 @@ def match_tex_dependency(dep, line, regex,
 	# find the files
 	fns = [ f + '.' + e for e in ext if e != '' ]
 	fns.append(f)
-	found = [ nf for nf in fns if os.path.isfile(nf) ]
+	found = [ nf for nf in fns if isfile(nf) ]
 	# set f to the found file
 	if len(found) > 0:
-		f = found[0]
-	else:
-		# try to set the default extension
-		if extdef != '' and not f.endswith('.' + extdef):
-			f += '.' + extdef
-		if optional and not os.path.isfile(f):
-			return # nothing has been found
-	# add the file
-	if f in dep: return
-	dep.add(f)
-	find_dependencies(f, dep)
-
-def latex_lines(f):
-	"""Generator for relevant latex lines (without comments or spaces)."""
-	acc = ''
-	result = True
-	for line in f:
-		result = True
-		i = line.find('%')
-		while i >= 0:
-			if i == 0 or line[i - 1] != '\\':
-				result = False
-				line = line[:i]
-				break
-			i = line.find('%', i + 1)
-		acc += line
-		if result:
-			yield acc
-			acc = ''
-	if not result:
-		yield acc
+		return found[0]
+	# try to set the default extension
+	if extdef != '' and not f.endswith('.' + extdef):
+		f += '.' + extdef
+	if optional and not isfile(f):
+		return None # nothing has been found
+	return f
+
+# a comment with the end of its line (the next line is joined)
+LATEX_COMMENT_REGEX = re.compile('(?<!\\\\)%[^\n]*\n?')
+
+# a command or a group delimiter (escaped characters are skipped)
+LATEX_SPLIT_REGEX = re.compile(r'\\.|[{}\[\]]', re.DOTALL)
+
+def split_position(text):
+	"""Gets the start of the last command of text which is not in a group
+	or an optional argument (0 if none)."""
+	depth = 0
+	position = 0
+	for m in LATEX_SPLIT_REGEX.finditer(text):
+		c = m.group(0)[0]
+		if c == '\\':
+			if depth == 0:
+				position = m.start()
+		elif c in '{[':
+			depth += 1
+		elif depth > 0:
+			depth -= 1
+	return position
+
+def latex_lines(f, block_size = 65536, max_length = 1048576):
+	"""Generator for relevant latex lines (without comments).
+
+	The file is read by blocks and the comments are removed from the
+	complete lines of each block. A line ending with a comment is joined
+	with the next one; joined lines longer than max_length are split
+	before their last command (see split_position), which is carried over
+	to the next part.
+	"""
+	parts = [] # parts of the current logical line
+	length = 0
+	rest = [] # incomplete physical line
+	while True:
+		block = f.read(block_size)
+		end = block.rfind('\n') + 1
+		if block != '' and end == 0:
+			rest.append(block)
+			continue
+		rest.append(block[:end])
+		text = LATEX_COMMENT_REGEX.sub('', ''.join(rest))
+		rest = [block[end:]] if end < len(block) else []
+		lines = text.split('\n')
+		if len(lines) > 1:
+			parts.append(lines[0])
+			yield ''.join(parts) + '\n'
+			parts = []
+			length = 0
+			for line in lines[1:-1]:
+				yield line + '\n'
+		if lines[-1] != '':
+			parts.append(lines[-1])
+			length += len(lines[-1])
+			if length > max_length:
+				text = ''.join(parts)
+				cut = split_position(text) or len(text)
+				yield text[:cut]
+				parts = [text[cut:]] if cut < len(text) else []
+				length = len(text) - cut
+		if block == '':
+			break
+	if parts:
+		yield ''.join(parts)
 
 # =========================================================
 
-def find_md_dependencies(filename, dep):
-	"""Generates markdown file dependencies"""
+# an example of reference: ![some text](url "optional description")
+MD_REFERENCE_REGEX = markdown_stream.INCLUDE_REGEX
+
+def find_md_dependencies(filename, cache = None, index = None,
+		stats = None):
+	"""Gets the direct dependencies of a markdown file as (path, type)."""
 	if os.path.splitext(filename)[1] not in ['.' + ext for ext in MD_EXT]:
 		sys.stderr.write("find_md_dependencies(%s): works only for markdown files\n"
 			% filename)
-		return dep
-	if not os.path.isfile(filename):
+		return []
+	if index is None:
+		index = FileIndex()
+	if not index.isfile(filename):
 		sys.stderr.write("find_md_dependencies(%s): file does not exist\n"
 			% filename)
-		return dep
-	# analyse the lines of the given file
+		return []
+	# the references of the given file
+	refs = read_references(filename, scan_md_file, cache, stats)
+	return resolve_references(filename, refs, index, stats)
+
+def scan_md_file(filename, info = None):
+	"""Returns the references of a markdown file.
+
+	info: a dict receiving the number of bytes and of lines read
+	"""
+	refs = []
+	lines = 0
+	with open(filename, 'r') as f:
+		for line in f:
+			lines += 1
+			m = MD_REFERENCE_REGEX.search(line)
+			if m is not None:
+				refs.append(m.group(1))
+		if info is not None:
+			info['bytes'] = os.fstat(f.fileno()).st_size
+			info['lines'] = lines
+	return refs
+
+# =========================================================
+
+def project_path(path):
+	"""Gets a path relative to the current directory (None if outside)."""
+	path = os.path.relpath(os.path.abspath(path))
+	if path == os.pardir or path.startswith(os.pardir + os.sep):
+		return None
+	return path
+
+def read_fls(filename):
+	"""Reads the files recorded by pdflatex -recorder in a .fls file.
+
+	Returns (inputs, outputs) as paths relative to the current directory,
+	the files outside of it (e.g. of the TeX distribution) are ignored.
+	"""
+	pwd = os.curdir
+	inputs = []
+	outputs = set()
 	with open(filename, 'r') as f:
 		for line in f:
-			# an example of reference: ![some text](url "optional description")
-			m = re.search(r'!\[[^]]+\]\(([^)]+)(?:\s["\'].*["\'])?\)', line)
-			if m is None: continue
-			url = m.group(1)
-			if url in dep or url.find('://') >= 0: continue
-			dep.add(url)
-			find_dependencies(url, dep)
+			kind, _, path = line.rstrip('\n').partition(' ')
+			if kind == 'PWD':
+				pwd = path
+				continue
+			if kind not in ['INPUT', 'OUTPUT']: continue
+			path = project_path(os.path.join(pwd, path))
+			if path is None: continue
+			if kind == 'INPUT':
+				inputs.append(path)
+			else:
+				outputs.add(path)
+	return inputs, outputs
+
+def recorded_dependencies(filename, index = None):
+	"""Gets the files read by pdflatex for a tex document.
+
+	The files written during the compilation and the auxiliary files of
+	the document (same name, other extension) are excluded.
+	Returns None when the document has no .fls file.
+	"""
+	if index is None:
+		index = FileIndex()
+	base = os.path.splitext(filename)[0]
+	fls = base + '.fls'
+	if not index.isfile(fls):
+		return None
+	try:
+		inputs, outputs = read_fls(fls)
+	except (IOError, UnicodeDecodeError):
+		sys.stderr.write("recorded_dependencies(%s): cannot read %s\n"
+			% (filename, fls))
+		return None
+	filename = os.path.normpath(filename)
+	base = os.path.normpath(base) + '.'
+	return set(path for path in inputs
+		if path not in outputs
+		and path != filename
+		and not path.startswith(base)
+		and index.isfile(path))
+
+def merge_recorded(find, index = None):
+	"""Wraps find to add the files recorded in the .fls of tex documents."""
+	def find_merged(filename):
+		dep = find(filename)
+		if dep is None or not filename.endswith('.tex'):
+			return dep
+		return set(dep) | (recorded_dependencies(filename, index) or set())
+	return find_merged
+
+# =========================================================
+
+def file_scanner(filename):
+	"""Gets the function reading the references of a file (or None)."""
+	ext = os.path.splitext(filename)[1]
+	if ext == '.tex':
+		return scan_tex_file
+	if ext in ['.' + e for e in MD_EXT]:
+		return scan_md_file
+	return None
+
+def resolve_references(filename, refs, index = None, stats = None):
+	"""Gets the dependencies as (path, type) from the references of a file.
+
+	stats: a DependencyStats receiving the resolution time of each type
+	"""
+	if filename.endswith('.tex'):
+		found = []
+		for command, ref in refs:
+			kind, _, options = TEX_COMMANDS[command]
+			start = time.perf_counter()
+			path = resolve_tex_dependency(ref, index = index, **options)
+			if stats is not None:
+				stats.add_reference(kind, time.perf_counter() - start)
+			if path is not None:
+				found.append((path, kind))
+		return found
+	found = [(url, 'markdown' if file_scanner(url) is not None else 'image')
+		for url in refs if url.find('://') < 0]
+	if stats is not None:
+		for _, kind in found:
+			stats.add_reference(kind, 0.0)
+	return found
+
+class FileIndex(object):
+	"""Index of the files in directories, each listed once with os.scandir.
+
+	Used instead of os.path.isfile while resolving the references, it must
+	be discarded when files may have been created or removed.
+	hits: number of lookups in an already listed directory
+	misses: number of listed directories
+	"""
+
+	def __init__(self):
+		self.directories = {}
+		self.hits = 0
+		self.misses = 0
+
+	def isfile(self, path):
+		"""Checks if a path is an existing file."""
+		directory, name = os.path.split(path)
+		files = self.directories.get(directory)
+		if files is None:
+			self.misses += 1
+			files = self.directories[directory] = self.list(directory)
+		else:
+			self.hits += 1
+		return name in files
+
+	@staticmethod
+	def list(directory):
+		"""Gets the set of file names in a directory."""
+		try:
+			with os.scandir(directory or os.curdir) as entries:
+				return set(e.name for e in entries if e.is_file())
+		except OSError:
+			return set()
+
+def read_references(filename, scan, cache = None, stats = None):
+	"""Reads the references of a file using scan or the cache."""
+	if stats is not None:
+		return stats.read_references(filename, scan, cache)
+	if cache is None:
+		return scan(filename)
+	return cache.references(filename, scan)
+
+def timed_scan(scan, filename):
+	"""Scans a file, returns (references, info with bytes, lines and time)."""
+	start = time.perf_counter()
+	info = {}
+	refs = scan(filename, info)
+	info['time'] = time.perf_counter() - start
+	return refs, info
+
+def hash_file(filename):
+	"""Returns a hash of a file."""
+	with open(filename, 'rb') as f:
+		return hashlib.md5(f.read()).hexdigest()
+
+class DependencyCache(object):
+	"""Persistent cache of the references found in each file.
+
+	An entry is valid while the mtime and the size of the file are unchanged.
+	When use_hash is set, the content hash is compared before parsing again a
+	file whose stat changed. The references are stored before resolution, so
+	that created or removed files are taken into account.
+	hits: number of valid entries found
+	misses: number of files not cached or outdated
+	"""
+
+	VERSION = 2
+
+	def __init__(self, filename, use_hash = False):
+		self.filename = filename
+		self.use_hash = use_hash
+		self.entries = {}
+		self.changed = False
+		self.hits = 0
+		self.misses = 0
+		self.load()
+
+	def load(self):
+		"""Loads the cache file (ignored if invalid or outdated)."""
+		if self.filename is None: return
+		try:
+			with open(self.filename, 'r') as f:
+				data = json.load(f)
+		except (IOError, OSError, ValueError):
+			return
+		if not isinstance(data, dict) or data.get('version') != self.VERSION:
+			return
+		self.entries = data.get('files', {})
+
+	def save(self):
+		"""Saves the cache file (atomically) if it changed."""
+		self.prune()
+		if not self.changed or self.filename is None: return
+		tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump({'version': self.VERSION, 'files': self.entries}, f,
+				sort_keys = True)
+		os.replace(tmp, self.filename)
+		self.changed = False
+
+	def prune(self):
+		"""Removes the entries of deleted files."""
+		for path in list(self.entries):
+			if not os.path.isfile(path):
+				del self.entries[path]
+				self.changed = True
+
+	def get(self, filename):
+		"""Gets the cached references of a file (None if outdated)."""
+		entry = self.entries.get(filename)
+		if entry is None:
+			self.misses += 1
+			return None
+		st = os.stat(filename)
+		if entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+			self.hits += 1
+			return entry['refs']
+		if self.use_hash and entry.get('hash') == hash_file(filename):
+			entry['mtime'] = st.st_mtime_ns
+			entry['size'] = st.st_size
+			self.changed = True
+			self.hits += 1
+			return entry['refs']
+		self.misses += 1
+		return None
+
+	def put(self, filename, refs):
+		"""Stores the references of a file."""
+		st = os.stat(filename)
+		entry = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'refs': refs}
+		if self.use_hash:
+			entry['hash'] = hash_file(filename)
+		self.entries[filename] = entry
+		self.changed = True
+
+	def references(self, filename, scan):
+		"""Gets the references of a file, calls scan when not cached."""
+		refs = self.get(filename)
+		if refs is None:
+			refs = scan(filename)
+			self.put(filename, refs)
+		return refs
+
+class DependencyStats(object):
+	"""Statistics of the parsing, given as stats to the find functions.
+
+	files: filename -> {'reads', 'parsed', 'bytes', 'lines', 'time'}
+	       (a file is read from the cache or parsed, possibly several times)
+	types: reference type -> {'references', 'time'} (time of the resolution)
+	documents: filename -> {'depth', 'dependencies', 'cycles'}
+	"""
+
+	def __init__(self):
+		self.files = {}
+		self.types = {}
+		self.documents = {}
+		self.start = time.perf_counter()
+
+	def read_references(self, filename, scan, cache = None):
+		"""Reads the references of a file (see read_references)."""
+		start = time.perf_counter()
+		refs = None if cache is None else cache.get(filename)
+		if refs is not None:
+			self.add_file(filename, {'time': time.perf_counter() - start},
+				cached = True)
+			return refs
+		refs, info = timed_scan(scan, filename)
+		if cache is not None:
+			cache.put(filename, refs)
+		info['time'] = time.perf_counter() - start
+		self.add_file(filename, info)
+		return refs
+
+	def add_file(self, filename, info = None, cached = False):
+		"""Records a file read (info: bytes, lines and time)."""
+		entry = self.files.get(filename)
+		if entry is None:
+			entry = self.files[filename] = {
+				'reads': 0, 'parsed': 0, 'bytes': 0, 'lines': 0, 'time': 0.0}
+		info = info or {}
+		entry['reads'] += 1
+		entry['time'] += info.get('time', 0.0)
+		if not cached:
+			entry['parsed'] += 1
+			entry['bytes'] += info.get('bytes', 0)
+			entry['lines'] += info.get('lines', 0)
+
+	def add_document(self, filename, depth, dependencies, cycles):
+		"""Records the traversal of a document (see find_dependencies)."""
+		self.documents[filename] = {
+			'depth': depth,
+			'dependencies': dependencies,
+			'cycles': cycles,
+		}
+
+	def add_reference(self, kind, duration):
+		"""Records the resolution of a reference."""
+		entry = self.types.setdefault(kind, {'references': 0, 'time': 0.0})
+		entry['references'] += 1
+		entry['time'] += duration
+
+	def report(self, index = None, cache = None, slowest = 10):
+		"""Gets the statistics as a JSON compatible dict."""
+		total = lambda key: sum(e[key] for e in self.files.values())
+		return {
+			'time': time.perf_counter() - self.start,
+			'files': {
+				'files': len(self.files),
+				'reads': total('reads'),
+				'parsed': total('parsed'),
+				'bytes': total('bytes'),
+				'lines': total('lines'),
+			},
+			'types': self.types,
+			'documents': self.documents,
+			'index': None if index is None else {
+				'lookups': index.hits + index.misses,
+				'directories': index.misses,
+			},
+			'cache': None if cache is None else {
+				'hits': cache.hits,
+				'misses': cache.misses,
+			},
+			'slowest': [dict(self.files[f], file = f) for f in sorted(
+				self.files, key = lambda f: -self.files[f]['time'])[:slowest]],
+			'per_file': self.files,
+		}
 
 # =========================================================
 
@@ -181,40 +614,269 @@ def write_dependencies(out, filename, deps, outext = 'pdf'):
 	write_dep(out, filename)
 	write_deps(out, deps, suffix = "\n\n")
 
-def find_dependencies(filename, dep = None):
-	"""Gets the dependencies for a file"""
-	no_result = dep
+def direct_dependencies(filename, cache = None, index = None,
+		stats = None):
+	"""Gets the direct dependencies of a file as (path, type).
+
+	Returns None if the type of file is not supported.
+	"""
+	if filename.endswith('.tex'):
+		return find_tex_dependencies(filename, cache, index, stats)
+	if os.path.splitext(filename)[1] in ['.' + ext for ext in MD_EXT]:
+		return find_md_dependencies(filename, cache, index, stats)
+	return None
+
+def find_dependencies(filename, dep = None, cache = None, index = None,
+		stats = None):
+	"""Gets the dependencies for a file
+
+	The files are visited depth first using an explicit stack (the Python
+	stack does not grow with the include depth), each file is parsed once.
+	The include cycles (only through INCLUDE_TYPES) are reported on stderr
+	(at most MAX_REPORTED_CYCLES).
+	dep: a set of dependencies to complete (their files are not visited)
+	cache: a DependencyCache
+	index: a FileIndex shared between the calls (created if None)
+	stats: a DependencyStats collecting the statistics
+	"""
+	if index is None:
+		index = FileIndex()
+	children = direct_dependencies(filename, cache, index, stats)
+	if children is None:
+		return dep
 	if dep is None:
 		dep = set()
-	if filename.endswith('.tex'):
-		find_tex_dependencies(filename, dep)
-	elif os.path.splitext(filename)[1] in ['.' + ext for ext in MD_EXT]:
-		find_md_dependencies(filename, dep)
-	else:
-		return no_result
+	visited = set(dep)
+	visited.add(filename)
+	chain = [filename] # the files being visited
+	others = [] # positions in the chain not referenced by INCLUDE_TYPES
+	position = {filename: 0} # file -> position in the chain
+	stack = [iter(children)]
+	depth = 0
+	cycles = []
+	while stack:
+		for child, kind in stack[-1]:
+			if (child in position and kind in INCLUDE_TYPES
+				and len(cycles) < MAX_REPORTED_CYCLES
+				and (not others or others[-1] <= position[child])):
+				cycles.append(chain[position[child]:] + [child])
+			dep.add(child)
+			if child in visited: continue
+			visited.add(child)
+			children = direct_dependencies(child, cache, index, stats)
+			if not children: continue
+			position[child] = len(chain)
+			chain.append(child)
+			if kind not in INCLUDE_TYPES:
+				others.append(position[child])
+			stack.append(iter(children))
+			depth = max(depth, len(stack) - 1)
+			break
+		else:
+			stack.pop()
+			if others and others[-1] == len(chain) - 1:
+				others.pop()
+			del position[chain.pop()]
+	for cycle in cycles:
+		if len(cycle) > 7:
+			cycle = (cycle[:3] + ['... (%d files)' % (len(cycle) - 6)]
+				+ cycle[-3:])
+		sys.stderr.write("find_dependencies(%s): include cycle: %s\n"
+			% (filename, ' -> '.join(cycle)))
+	if stats is not None:
+		stats.add_document(filename, depth, len(dep), cycles)
 	return dep
 
+class DependencyGraph(object):
+	"""Graph of files (nodes) with typed dependencies (edges).
+
+	The type of an edge is one of: tex, sty, cls, bib, image, listing,
+	markdown. The transitive closure of the requested files is memoized.
+	"""
+
+	def __init__(self):
+		self.edges = {} # file -> {dependency: type}
+		self.reverse = {} # file -> set of files depending on it
+		self._closure = {}
+
+	def __contains__(self, filename):
+		return filename in self.edges
+
+	def add_node(self, filename):
+		"""Adds a file to the graph."""
+		if filename not in self.edges:
+			self.edges[filename] = {}
+			self.reverse[filename] = set()
+
+	def add_edge(self, filename, dependency, kind):
+		"""Adds a dependency of a given type to a file."""
+		self.add_node(filename)
+		self.add_node(dependency)
+		if dependency in self.edges[filename]: return
+		self.edges[filename][dependency] = kind
+		self.reverse[dependency].add(filename)
+		self._closure = {}
+
+	def dependencies(self, filename):
+		"""Gets the direct dependencies of a file."""
+		return list(self.edges.get(filename, {}))
+
+	def closure(self, filename):
+		"""Gets the set of files reachable from a file (memoized).
+
+		The file itself is included only when it is in a cycle. The closures
+		are kept for the requested files only: each one is a traversal of the
+		graph, linear in its size.
+		"""
+		if filename in self._closure:
+			return self._closure[filename]
+		reach = set()
+		stack = list(self.edges.get(filename, {}))
+		while stack:
+			path = stack.pop()
+			if path in reach: continue
+			reach.add(path)
+			stack.extend(self.edges.get(path, {}))
+		reach = frozenset(reach)
+		self._closure[filename] = reach
+		return reach
+
+	def dependents(self, filename):
+		"""Gets the set of files which depend (transitively) on a file."""
+		found = set()
+		stack = list(self.reverse.get(filename, ()))
+		while stack:
+			path = stack.pop()
+			if path in found: continue
+			found.add(path)
+			stack.extend(self.reverse.get(path, ()))
+		return found
+
+	def affected(self, filename, roots):
+		"""Gets the roots which must be rebuilt when a file changes."""
+		found = self.dependents(filename)
+		found.add(filename)
+		return [root for root in roots if root in found]
+
+	def to_json(self):
+		"""Exports the graph as a JSON compatible dict."""
+		return {
+			'nodes': sorted(self.edges),
+			'edges': [
+				{'from': path, 'to': dep, 'type': kind}
+				for path in sorted(self.edges)
+				for dep, kind in sorted(self.edges[path].items())],
+		}
+
+	def write_dot(self, out):
+		"""Writes the graph in the DOT format (graphviz)."""
+		quote = lambda f: '"%s"' % f.replace('\\', '\\\\').replace('"', '\\"')
+		out.write("digraph dependencies {\n")
+		for path in sorted(self.edges):
+			out.write("\t%s;\n" % quote(path))
+		for path in sorted(self.edges):
+			for dep, kind in sorted(self.edges[path].items()):
+				out.write("\t%s -> %s [label=%s];\n"
+					% (quote(path), quote(dep), quote(kind)))
+		out.write("}\n")
+
+def parse_dependency_graph(filenames, jobs = 1, cache = None, index = None,
+		stats = None, missing = None):
+	"""Parses once each file reachable from the given files.
+
+	Returns a DependencyGraph containing each visited file.
+	When jobs > 1, the files are scanned by a pool of processes.
+	missing: the set of the missing files already reported, updated (they
+	are reported again once they exist)
+	"""
+	if index is None:
+		index = FileIndex()
+	graph = DependencyGraph()
+	absent = set()
+	parsed = [] # (filename, refs) to resolve
+	pending = {} # future -> filename
+	pool = None
+	if jobs > 1:
+		pool = concurrent.futures.ProcessPoolExecutor(jobs)
+	def visit(path):
+		if path in graph: return
+		graph.add_node(path)
+		scan = file_scanner(path)
+		if scan is None: return
+		if not index.isfile(path):
+			if missing is None or path not in missing:
+				sys.stderr.write(
+					"parse_dependency_graph(%s): file does not exist\n" % path)
+			absent.add(path)
+			return
+		if pool is None:
+			parsed.append((path, read_references(path, scan, cache, stats)))
+			return
+		refs = None if cache is None else cache.get(path)
+		if refs is not None:
+			if stats is not None: stats.add_file(path, cached = True)
+			parsed.append((path, refs))
+		else:
+			pending[pool.submit(timed_scan, scan, path)] = path
+	try:
+		for filename in filenames:
+			visit(filename)
+		while parsed or pending:
+			while parsed:
+				path, refs = parsed.pop()
+				for dep, kind in resolve_references(path, refs, index, stats):
+					visit(dep)
+					graph.add_edge(path, dep, kind)
+			if not pending: continue
+			done, _ = concurrent.futures.wait(pending,
+				return_when = concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				path = pending.pop(future)
+				refs, info = future.result()
+				if stats is not None: stats.add_file(path, info)
+				if cache is not None: cache.put(path, refs)
+				parsed.append((path, refs))
+	finally:
+		if pool is not None:
+			pool.shutdown()
+	if missing is not None:
+		missing.clear()
+		missing.update(absent)
+	return graph
+
+def graph_dependencies(graph, filename):
+	"""Gets the dependencies for a file from a parsed graph"""
+	if file_scanner(filename) is None:
+		return None
+	return set(graph.closure(filename))
+
 # =========================================================
 
-def main():
-	"""The main program."""
-	out = sys.stdout
+def source_dependencies(deps):
+	"""Filters the dependencies which are parsed (their references may
+	change the dependencies)."""
+	return set(dep for dep in deps if os.path.splitext(dep)[1] in
+		['.' + ext for ext in ['bib', 'cls', 'tex'] + MD_EXT])
+
+def write_makefile(out, paths, find):
+	"""Writes the Makefile with the dependencies of the given files.
+
+	find: function returning the dependencies of a file (None if unsupported)
+	"""
 	out.write("###########################################\n")
 	out.write("# Makefile (LaTeX) generated dependencies #\n")
 	out.write("###########################################\n")
 	out.write("\n")
 	alldeps = set()
-	for path in sys.argv[1:]:
-		dep = find_dependencies(path)
+	for path in paths:
+		dep = find(path)
 		if dep is None:
 			sys.stderr.write("Unsupported file: %s" % path)
 			continue
 		write_dependencies(out, path, dep)
 		alldeps |= set(dep)
 		alldeps.add(path)
-	accept = lambda f: (os.path.splitext(f)[1] in
-		['.' + ext for ext in ['bib', 'cls', 'tex'] + MD_EXT])
-	alldeps = set(i for i in alldeps if accept(i))
+	alldeps = source_dependencies(alldeps)
 	out.write("# Dependencies of this file\nMakefile.d:")
 	for path in GEN_FROM:
 		if os.path.exists(path):
@@ -222,5 +884,302 @@ def main():
 	write_deps(out, alldeps, "\n\n")
 	out.write("# EOF\n")
 
+def depfile_path(directory, filename, outext = 'pdf'):
+	"""Gets the dependency file of a document in a directory."""
+	return os.path.join(directory,
+		os.path.splitext(filename)[0] + '.' + outext + '.d')
+
+def read_depfile_index(directory):
+	"""Reads the index of the dependency files as {document: depfile}."""
+	index = {}
+	try:
+		with open(os.path.join(directory, DEPFILE_INDEX), 'r') as f:
+			for line in f:
+				if line.startswith('#') or ' ' not in line: continue
+				document, depfile = line.rstrip('\n').split(' ', 1)
+				index[document] = depfile
+	except (IOError, OSError):
+		pass
+	return index
+
+def update_depfile_index(directory, depfiles):
+	"""Adds the dependency files {document: depfile} to the index and
+	deletes those of the documents which were removed.
+
+	The index is locked while it is read and written, as the documents
+	may be processed concurrently (make -j).
+	Returns the list of the deleted files.
+	"""
+	removed = []
+	os.makedirs(directory, exist_ok = True)
+	with open(os.path.join(directory, DEPFILE_INDEX + '.lock'), 'w') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		index = read_depfile_index(directory)
+		index.update(depfiles)
+		for document, depfile in list(index.items()):
+			if not os.path.isfile(document):
+				del index[document]
+				if os.path.isfile(depfile):
+					os.remove(depfile)
+					removed.append(depfile)
+		content = io.StringIO()
+		content.write("# Dependency files of the documents (doc_depgen)\n")
+		for document in sorted(index):
+			content.write("%s %s\n" % (document, index[document]))
+		write_if_changed(os.path.join(directory, DEPFILE_INDEX),
+			content.getvalue())
+	return removed
+
+def write_split(directory, paths, find, use_fls = False):
+	"""Writes one dependency file per document in directory and an index.
+
+	Each file depends on the parsed files of its document only, so that it
+	is regenerated (and rewritten if its content changed) only when they
+	change. As with gcc -MP, they get empty rules so that removing a file
+	does not break the build. An unchanged file is touched, otherwise make
+	would regenerate it on every run.
+	The index lists the documents and their files; the files of the
+	documents which were removed are deleted.
+	Returns the list of the updated files.
+	"""
+	updated = []
+	depfiles = {}
+	for path in paths:
+		dep = find(path)
+		if dep is None:
+			sys.stderr.write("Unsupported file: %s" % path)
+			continue
+		depfile = depfile_path(directory, path)
+		content = io.StringIO()
+		write_dependencies(content, path, dep)
+		sources = source_dependencies(set(dep) | set([path]))
+		fls = os.path.splitext(path)[0] + '.fls'
+		if use_fls and os.path.isfile(fls):
+			sources.add(fls)
+		content.write("# Dependencies of this file\n")
+		write_dep(content, depfile)
+		content.write(':')
+		write_deps(content, sources, "\n\n")
+		for source in sorted(sources - set([path])):
+			write_dep(content, source)
+			content.write(":\n")
+		content.write("\n")
+		content.write("# EOF\n")
+		os.makedirs(os.path.dirname(depfile), exist_ok = True)
+		if write_if_changed(depfile, content.getvalue()):
+			updated.append(depfile)
+		else:
+			os.utime(depfile)
+		depfiles[path] = depfile
+	updated.extend(update_depfile_index(directory, depfiles))
+	return updated
+
+def write_if_changed(filename, content):
+	"""Replaces atomically a file if its content changed."""
+	try:
+		with open(filename, 'r') as f:
+			if f.read() == content:
+				return False
+	except (IOError, OSError):
+		pass
+	tmp = '%s.%d.tmp' % (filename, os.getpid())
+	with open(tmp, 'w') as f:
+		f.write(content)
+	os.replace(tmp, filename)
+	return True
+
+def watch_dependencies(output, paths, interval = 1.0, jobs = None,
+		cache = None, use_fls = False, split = None, pidfile = None):
+	"""Keeps the dependencies in output up-to-date until interrupted.
+
+	The references are kept in memory (in cache) and the files are polled,
+	only the modified ones are parsed again. The output is rewritten only
+	when the dependencies changed, with the same content as without --watch.
+	split: writes one file per document in this directory instead
+	pidfile: file containing the process id while watching, so that the
+	Makefile does not regenerate the output concurrently
+	"""
+	if cache is None:
+		cache = DependencyCache(None)
+	if pidfile is not None:
+		write_if_changed(pidfile, '%d\n' % os.getpid())
+	missing = set()
+	try:
+		while True:
+			graph = parse_dependency_graph(paths, jobs = jobs or 1,
+				cache = cache, missing = missing)
+			jobs = None # the pool is useful only for the initial parsing
+			find = lambda path: graph_dependencies(graph, path)
+			if use_fls:
+				find = merge_recorded(find)
+			if split is not None:
+				for depfile in write_split(split, paths, find,
+						use_fls = use_fls):
+					sys.stderr.write("Updated: %s\n" % depfile)
+			else:
+				content = io.StringIO()
+				write_makefile(content, paths, find)
+				if write_if_changed(output, content.getvalue()):
+					sys.stderr.write("Updated: %s\n" % output)
+			cache.save()
+			time.sleep(interval)
+	finally:
+		if pidfile is not None and os.path.isfile(pidfile):
+			os.remove(pidfile)
+
+def write_stats(filename, report):
+	"""Writes the statistics as JSON to a file ("-" for stderr)."""
+	if filename == '-':
+		json.dump(report, sys.stderr, indent = 1, sort_keys = True)
+		sys.stderr.write("\n")
+		return
+	with open(filename, 'w') as f:
+		json.dump(report, f, indent = 1, sort_keys = True)
+		f.write("\n")
+
+def run(paths, cache, index, stats, jobs, graph_format, affected,
+		output, watch, interval, use_fls = False, split = None,
+		pidfile = None):
+	"""Runs the main program with the parsed arguments."""
+	out = sys.stdout
+	# Query the graph
+	if graph_format is not None or affected:
+		graph = parse_dependency_graph(paths, jobs = jobs or 1, cache = cache,
+			index = index, stats = stats)
+		if cache is not None:
+			cache.save()
+		if graph_format == 'dot':
+			graph.write_dot(out)
+		elif graph_format is not None:
+			json.dump(graph.to_json(), out, indent = 1, sort_keys = True)
+			out.write("\n")
+		for path in affected:
+			for root in graph.affected(os.path.normpath(path), paths):
+				out.write(os.path.splitext(root)[0] + '.pdf\n')
+		return
+	# Watch the files
+	if watch:
+		if output is None and split is None:
+			sys.stderr.write("--watch requires an --output file\n")
+			sys.exit(1)
+		try:
+			watch_dependencies(output, paths, interval = interval,
+				jobs = jobs, cache = cache, use_fls = use_fls, split = split,
+				pidfile = pidfile)
+		except KeyboardInterrupt:
+			if cache is not None:
+				cache.save()
+		return
+	# Write the dependencies
+	if jobs is None:
+		find = lambda path: find_dependencies(path, cache = cache,
+			index = index, stats = stats)
+	else:
+		graph = parse_dependency_graph(paths, jobs = jobs, cache = cache,
+			index = index, stats = stats)
+		find = lambda path: graph_dependencies(graph, path)
+	if use_fls:
+		find = merge_recorded(find, index)
+	if split is not None:
+		write_split(split, paths, find, use_fls = use_fls)
+	elif output is None:
+		write_makefile(out, paths, find)
+	else:
+		content = io.StringIO()
+		write_makefile(content, paths, find)
+		write_if_changed(output, content.getvalue())
+	if cache is not None:
+		cache.save()
+
+def main():
+	"""The main program.
+
+	Usage: [--cache file] [--cache-hash] [--jobs n]
+	       [--graph json|dot] [--affected file]
+	       [--output file] [--watch] [--interval seconds] [--pidfile file]
+	       [--stats file] [--profile file] [--fls] [--split directory]
+	       [--] files
+
+	--cache reuses the references of unchanged files stored in a cache file
+	--cache-hash compares the content of files whose stat changed
+	--jobs parses each file once for all the documents using n processes
+	--graph writes the dependency graph instead of the Makefile
+	--affected lists the documents to rebuild when a file changes
+	--output writes the Makefile to a file (only if it changed)
+	--watch keeps the output file up-to-date (polling every interval)
+	--pidfile writes the process id to a file while watching
+	--stats writes statistics of the parsing as JSON ("-" for stderr)
+	--profile writes the cProfile statistics to a file (see pstats)
+	--fls adds the files recorded by pdflatex -recorder (document.fls)
+	--split writes one file per document in a directory (see write_split)
+	"""
+	# Parse arguments
+	cache_file = None
+	use_hash = False
+	jobs = None
+	graph_format = None
+	affected = []
+	output = None
+	watch = False
+	interval = 1.0
+	stats_file = None
+	profile_file = None
+	use_fls = False
+	split = None
+	pidfile = None
+	paths = []
+	args = iter(sys.argv[1:])
+	for arg in args:
+		if arg == '--':
+			paths.extend(args)
+		elif arg == '--cache':
+			cache_file = next(args, None)
+		elif arg == '--cache-hash':
+			use_hash = True
+		elif arg == '--jobs':
+			jobs = int(next(args, 1))
+		elif arg == '--graph':
+			graph_format = next(args, 'json')
+		elif arg == '--affected':
+			affected.append(next(args, ''))
+		elif arg == '--output':
+			output = next(args, None)
+		elif arg == '--watch':
+			watch = True
+		elif arg == '--interval':
+			interval = float(next(args, interval))
+		elif arg == '--stats':
+			stats_file = next(args, '-')
+		elif arg == '--profile':
+			profile_file = next(args, None)
+		elif arg == '--fls':
+			use_fls = True
+		elif arg == '--split':
+			split = next(args, None)
+		elif arg == '--pidfile':
+			pidfile = next(args, None)
+		else:
+			paths.append(arg)
+	cache = None
+	if cache_file is not None:
+		cache = DependencyCache(cache_file, use_hash = use_hash)
+	index = FileIndex()
+	stats = None
+	if stats_file is not None:
+		stats = DependencyStats()
+	profile = None
+	if profile_file is not None:
+		profile = cProfile.Profile()
+		profile.enable()
+	try:
+		run(paths, cache, index, stats, jobs, graph_format, affected,
+			output, watch, interval, use_fls, split, pidfile)
+	finally:
+		if profile is not None:
+			profile.disable()
+			profile.dump_stats(profile_file)
+		if stats is not None:
+			write_stats(stats_file, stats.report(index, cache))
+
 if __name__ == '__main__':
 	main()
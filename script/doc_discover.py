@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Finds the root documents of a directory (same rules as DOC_AUTOFIND):
+
+- tex files whose first line (except empty lines and comments) is a
+  \\documentclass
+- markdown files whose first line (not starting with a space) is a header
+  (starts with %)
+- rst files
+
+Only the head of the files is read (up to the first relevant line) and the
+results can be cached by mtime.
+"""
+
+import json
+import os
+import os.path
+import re
+import sys
+
+MD_EXT = ['md', 'markdown', 'mkdn', 'mdown']
+DOCUMENTCLASS_REGEX = re.compile(r'\s*\\documentclass')
+TEX_SKIPPED_REGEX = re.compile(r'\s*($|%)')
+
+def is_tex_document(f):
+	"""Checks if the first relevant line of a tex file is a document class."""
+	for line in f:
+		if DOCUMENTCLASS_REGEX.match(line):
+			return True
+		if not TEX_SKIPPED_REGEX.match(line):
+			return False
+	return False
+
+def is_md_document(f):
+	"""Checks if a markdown file starts with a header."""
+	for line in f:
+		if line[:1].isspace():
+			continue
+		return line.startswith('%')
+	return False
+
+class DiscoveryCache(object):
+	"""Cache of the results of is_document, valid while the mtime and the
+	size of the file are unchanged."""
+
+	VERSION = 1
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.entries = {}
+		self.changed = False
+		self.load()
+
+	def load(self):
+		"""Loads the cache file (ignored if invalid or outdated)."""
+		try:
+			with open(self.filename, 'r') as f:
+				data = json.load(f)
+		except (IOError, OSError, ValueError):
+			return
+		if isinstance(data, dict) and data.get('version') == self.VERSION:
+			self.entries = data.get('files', {})
+
+	def save(self, names=None):
+		"""Saves the cache file if it changed, keeping only names."""
+		if names is not None:
+			for name in list(self.entries):
+				if name not in names:
+					del self.entries[name]
+					self.changed = True
+		if not self.changed: return
+		tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+		try:
+			with open(tmp, 'w') as f:
+				json.dump({'version': self.VERSION, 'files': self.entries}, f,
+					sort_keys=True)
+			os.replace(tmp, self.filename)
+		finally:
+			if os.path.isfile(tmp):
+				os.remove(tmp)
+		self.changed = False
+
+	def is_document(self, filename):
+		"""Checks if a file is a root document (cached)."""
+		st = os.stat(filename)
+		entry = self.entries.get(filename)
+		if (entry is not None
+			and entry['mtime'] == st.st_mtime_ns
+			and entry['size'] == st.st_size):
+			return entry['document']
+		document = is_document(filename)
+		self.entries[filename] = {
+			'mtime': st.st_mtime_ns, 'size': st.st_size, 'document': document}
+		self.changed = True
+		return document
+
+def is_document(filename):
+	"""Checks if a file is a root document."""
+	ext = os.path.splitext(filename)[1][1:]
+	if ext == 'rst':
+		return True
+	if ext == 'tex':
+		check = is_tex_document
+	elif ext in MD_EXT:
+		check = is_md_document
+	else:
+		return False
+	try:
+		with open(filename, 'r') as f:
+			return check(f)
+	except (IOError, UnicodeDecodeError):
+		return False
+
+def find_documents(directory='', cache=None):
+	"""Lists the root documents in a directory (tex, markdown, rst).
+
+	cache: a DiscoveryCache
+	"""
+	with os.scandir(directory or os.curdir) as entries:
+		names = sorted(entry.name for entry in entries if entry.is_file())
+	by_ext = lambda exts: [name for name in names
+		if os.path.splitext(name)[1][1:] in exts]
+	check = is_document if cache is None else cache.is_document
+	return [name
+		for name in by_ext(['tex']) + by_ext(MD_EXT) + by_ext(['rst'])
+		if check(os.path.join(directory, name))]
+
+def main():
+	"""The main program.
+
+	Usage: [--cache file] [directory]
+
+	--cache reuses the results for unchanged files stored in a cache file
+	"""
+	cache = None
+	directory = ''
+	args = iter(sys.argv[1:])
+	for arg in args:
+		if arg == '--cache':
+			cache = DiscoveryCache(next(args, None))
+		else:
+			directory = arg
+	documents = find_documents(directory, cache=cache)
+	# the list is written first: the cache is optional (read-only directory)
+	sys.stdout.write(' '.join(documents) + '\n')
+	sys.stdout.flush()
+	if cache is not None:
+		try:
+			with os.scandir(directory or os.curdir) as entries:
+				cache.save(set(os.path.join(directory, entry.name)
+					for entry in entries))
+		except OSError as ex:
+			sys.stderr.write("Cannot save the cache: %s\n" % ex)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Generates a build.ninja file (same builds as the Makefile):
+
+- the documents (tex, markdown, rst) with the dependencies of doc_depgen
+- the images with the conversions of img_build
+
+The graph is scanned once; build.ninja is regenerated by ninja when one of
+the scanned files, the files recorded by pdflatex (.fls) or the list of the
+sources (documents found by doc_discover, images) change. The list is
+checked by ninja before each build. The markdown dependencies are read from
+the depfile written by markdown_stream.
+"""
+
+import io
+import os
+import os.path
+import shlex
+import shutil
+import sys
+
+import doc_depgen
+import doc_discover
+import img_build
+
+NINJA_FILE = 'build.ninja'
+# List of the sources (next to the ninja file)
+SOURCES_SUFFIX = '.sources'
+DEPFILE_DIR = '.deps'
+
+# Variables of the Makefile that can be given as NAME=value
+DEFAULT_CONFIG = dict(img_build.DEFAULT_CONFIG, **{
+	'DOCUTILS_TEX': 'rst2latex.py',
+	'PANDOC': 'pandoc',
+	'PANDOC_FLAGS': '--smart',
+	'PDF_LATEX_FLAGS': '-shell-escape -recorder -interaction batchmode',
+	'PYTHON': 'python',
+})
+
+def ninja_escape(path):
+	"""Escapes a path in a build statement."""
+	return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+def ninja_paths(paths):
+	"""Gets the escaped paths separated by spaces."""
+	return ' '.join(ninja_escape(path) for path in paths)
+
+def shell_command(command, cwd=None, stdout=None, stdin=None):
+	"""Gets the shell command of an img_build conversion."""
+	line = ' '.join(shlex.quote(arg) for arg in command)
+	if stdin is not None:
+		line += ' < ' + shlex.quote(stdin)
+	if stdout is not None:
+		line += ' > ' + shlex.quote(stdout)
+	if cwd is not None:
+		line = 'cd %s && %s' % (shlex.quote(cwd), line)
+	return line.replace('$', '$$')
+
+def latex_command(config):
+	"""Gets the command compiling a tex file ($in) into $out."""
+	if shutil.which('latexmk') is not None:
+		return ('cd $dir && latexmk -r %s -pdf -dvi- -ps- -gg $name'
+			' > /dev/null' % shlex.quote(os.path.abspath(os.path.join(
+				config['SCRIPT_DIR'], 'latexmkrc'))))
+	# passes until the aux files are stable (see latex_build)
+	return '%s %s --quiet %s $in' % (config['PYTHON'],
+		shlex.quote(os.path.join(config['SCRIPT_DIR'], 'latex_build.py')),
+		shlex.quote('PDF_LATEX_FLAGS=' + config['PDF_LATEX_FLAGS']))
+
+def write_rules(out, config):
+	"""Writes the rules."""
+	script = lambda name: '%s %s' % (config['PYTHON'],
+		shlex.quote(os.path.join(config['SCRIPT_DIR'], name)))
+	out.write("rule latex\n")
+	out.write("  command = %s\n" % latex_command(config))
+	out.write("  description = LaTeX compile: $in\n\n")
+	out.write("rule markdown\n")
+	depfile = os.path.join(DEPFILE_DIR, '$out.d')
+	out.write("  command = %s --depfile %s --target $out"
+		" --exec %s %s -o $out -- $in\n"
+		% (script('markdown_stream.py'), depfile, config['PANDOC'],
+			config['PANDOC_FLAGS']))
+	out.write("  depfile = %s\n" % depfile)
+	out.write("  description = Generating $out from markdown\n\n")
+	out.write("rule docutils\n")
+	out.write("  command = %s $in $out\n" % config['DOCUTILS_TEX'])
+	out.write("  description = Generating $out using docutils\n\n")
+	out.write("rule convert\n")
+	out.write("  command = $command\n")
+	out.write("  description = Generating $out\n\n")
+	out.write("rule sources\n")
+	out.write("  command = %s --sources $args\n" % script('doc_ninja.py'))
+	out.write("  description = Checking the list of the sources\n")
+	out.write("  restat = 1\n\n")
+	out.write("rule regenerate\n")
+	out.write("  command = %s $args\n" % script('doc_ninja.py'))
+	out.write("  description = Regenerating $out\n")
+	out.write("  generator = 1\n")
+	# (build.ninja is rewritten only if it changed)
+	out.write("  restat = 1\n\n")
+
+def write_latex(out, tex, deps):
+	"""Writes the build of a tex document."""
+	directory, name = os.path.split(tex)
+	deps = sorted(set(deps) - set([tex]))
+	out.write("build %s: latex %s%s\n" % (
+		ninja_escape(os.path.splitext(tex)[0] + '.pdf'), ninja_escape(tex),
+		' | ' + ninja_paths(deps) if deps else ''))
+	out.write("  dir = %s\n" % (directory or os.curdir))
+	out.write("  name = %s\n" % name)
+
+def write_images(out, sources, config):
+	"""Writes the builds of the generated images, returns the outputs."""
+	outputs = []
+	for src in img_build.remove_intermediate(sources):
+		for step_src, step_dest, conversion in img_build.image_steps(src):
+			command = conversion(step_src, step_dest, config)
+			out.write("build %s: convert %s\n" % (ninja_escape(step_dest),
+				ninja_escape(step_src)))
+			out.write("  command = %s\n" % shell_command(*command))
+			outputs.append(step_dest)
+	return outputs
+
+def recorded_files(documents):
+	"""Lists the existing files recorded by pdflatex (.fls) of the tex
+	documents."""
+	return [os.path.splitext(doc)[0] + '.fls' for doc in documents
+		if doc.endswith('.tex')
+		and os.path.isfile(os.path.splitext(doc)[0] + '.fls')]
+
+def list_sources(documents, images):
+	"""Gets the content of the list of the sources (with the recorded files,
+	which appear after the first compilation)."""
+	return ''.join(path + '\n' for path in
+		list(documents) + recorded_files(documents) + sorted(images))
+
+def write_ninja(out, documents, images, config=None, cache=None,
+		output=NINJA_FILE, args=()):
+	"""Writes the build.ninja of the documents and the images.
+
+	The files recorded by pdflatex (see doc_depgen.recorded_dependencies)
+	are added to the dependencies of the tex documents.
+	output: the ninja file, regenerated using args
+	Returns the list of the files scanned for the dependencies.
+	"""
+	if config is None:
+		config = DEFAULT_CONFIG
+	out.write("# Generated by doc_ninja.py, do not edit\n")
+	out.write("ninja_required_version = 1.7\n\n")
+	write_rules(out, config)
+	out.write("# Images\n")
+	image_outputs = write_images(out, images, config)
+	out.write("build images: phony %s\n\n" % ninja_paths(image_outputs))
+	out.write("# Documents\n")
+	tex_documents = [doc for doc in documents if doc.endswith('.tex')]
+	graph = doc_depgen.parse_dependency_graph(tex_documents, cache=cache)
+	outputs = []
+	for doc in documents:
+		base, ext = os.path.splitext(doc)
+		if ext == '.tex':
+			deps = doc_depgen.graph_dependencies(graph, doc)
+			deps |= doc_depgen.recorded_dependencies(doc) or set()
+			write_latex(out, doc, deps)
+		elif ext == '.rst':
+			out.write("build %s: docutils %s\n" % (ninja_escape(base + '.tex'),
+				ninja_escape(doc)))
+			write_latex(out, base + '.tex', [])
+		else:
+			out.write("build %s: markdown %s\n" % (ninja_escape(base + '.pdf'),
+				ninja_escape(doc)))
+		outputs.append(base + '.pdf')
+	out.write("build documents: phony %s\n\n" % ninja_paths(outputs))
+	# regenerate when a reference or the list of the sources may have changed
+	args = ' '.join(shlex.quote(arg) for arg in args).replace('$', '$$')
+	sources = output + SOURCES_SUFFIX
+	out.write("build %s: phony\n" % ninja_escape(sources + '.force'))
+	out.write("build %s: sources | %s\n" % (ninja_escape(sources),
+		ninja_escape(sources + '.force')))
+	out.write("  args = %s\n" % args)
+	scanned = sorted(path for path in graph.edges
+		if doc_depgen.file_scanner(path) is not None and os.path.isfile(path))
+	out.write("build %s: regenerate | %s\n" % (ninja_escape(output),
+		ninja_paths(scanned + sorted(recorded_files(documents)) + [sources]
+			+ [os.path.join(config['SCRIPT_DIR'], name)
+			for name in ['doc_depgen.py', 'doc_ninja.py', 'img_build.py']])))
+	out.write("  args = %s\n\n" % args)
+	out.write("default documents images\n")
+	return scanned
+
+def main():
+	"""The main program.
+
+	Usage: [--cache file] [--output file] [--sources] [NAME=value...]
+	       [documents]
+
+	--cache reuses the references stored in a cache file (see doc_depgen)
+	--output sets the ninja file (default: NINJA_FILE)
+	--sources only updates the list of the sources (run by ninja)
+	NAME=value sets a variable (see DEFAULT_CONFIG)
+	The documents are found using doc_discover if none is given, the
+	images are found in img_build.IMG_ROOT_DIR.
+	"""
+	config = dict(DEFAULT_CONFIG)
+	cache = None
+	output = NINJA_FILE
+	sources_only = False
+	documents = []
+	args = iter(sys.argv[1:])
+	for arg in args:
+		if arg == '--cache':
+			cache = doc_depgen.DependencyCache(next(args, None))
+		elif arg == '--output':
+			output = next(args, output)
+		elif arg == '--sources':
+			sources_only = True
+		elif '=' in arg and arg.split('=', 1)[0] in config:
+			name, value = arg.split('=', 1)
+			config[name] = value
+		else:
+			documents.append(arg)
+	if not documents:
+		documents = doc_discover.find_documents()
+	images = img_build.find_sources()
+	doc_depgen.write_if_changed(output + SOURCES_SUFFIX,
+		list_sources(documents, images))
+	if sources_only:
+		return
+	content = io.StringIO()
+	write_ninja(content, documents, images, config=config, cache=cache,
+		output=output, args=sys.argv[1:])
+	if cache is not None:
+		cache.save()
+	doc_depgen.write_if_changed(output, content.getvalue())
+
+if __name__ == '__main__':
+	main()
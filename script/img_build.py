@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""
+Builds the generated images (same conversions as the Makefile).
+
+- a conversion is skipped when the hash of its source and the output match
+  the fingerprint stored after the last conversion (touching files, e.g.
+  after a checkout, does not rebuild anything)
+- the conversions run on a pool of workers
+- the PlantUML sources are converted by a single JVM invocation, except
+  the named diagrams (@startuml name) or the files with several diagrams
+  whose outputs are not named after the source
+"""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+
+FINGERPRINT_FILE = '.img-build-cache'
+HASH_BLOCK_SIZE = 1 << 16
+IMG_ROOT_DIR = 'img'
+# Start of a PlantUML diagram and its name (if any)
+PLANT_START_REGEX = re.compile(r'^\s*@startuml\b(.*)$', re.MULTILINE)
+
+# Variables of the Makefile that can be given as NAME=value
+DEFAULT_CONFIG = {
+	'DIA': 'dia',
+	'GRAPHVIZ_DOT': 'dot',
+	'JAVA': 'java',
+	'JAVADOC': 'javadoc',
+	'PDF_LATEX_FLAGS': '-shell-escape -interaction batchmode',
+	'PLANTUML_JAR': 'script/plantuml.jar',
+	'SCRIPT_DIR': 'script',
+	'UMLGRAPH_ARG': '-private',
+	'UMLGRAPH_JAR': 'script/UmlGraph.jar',
+}
+
+def hash_file(path):
+	"""Returns a hash of a file (read by blocks)."""
+	digest = hashlib.md5()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+# =========================================================
+# Conversions: each function returns (command, cwd, stdout file), followed
+# by the stdin file if any
+
+def split_path(path):
+	"""Returns (directory, file name) of a path."""
+	return os.path.dirname(path) or os.curdir, os.path.basename(path)
+
+def convert_dia(src, dest, config):
+	"""Converts a dia file."""
+	cwd, name = split_path(src)
+	return ([config['DIA'], '--export=' + os.path.basename(dest), name],
+		cwd, None)
+
+def convert_dot(src, dest, config):
+	"""Converts a dot file using graphviz."""
+	cwd, name = split_path(src)
+	return ([config['GRAPHVIZ_DOT'], '-T' + os.path.splitext(dest)[1][1:],
+		'-o', os.path.basename(dest), name], cwd, None)
+
+def convert_java(src, dest, config):
+	"""Converts a java file into a dot file using UmlGraph."""
+	return ([config['JAVADOC'], '-docletpath', config['UMLGRAPH_JAR'],
+		'-doclet', 'org.umlgraph.doclet.UmlGraph', '-output', dest]
+		+ config['UMLGRAPH_ARG'].split() + [src], None, None)
+
+def convert_pic(src, dest, config):
+	"""Converts a pic file using plotutils."""
+	return (['pic2plot', '-T' + os.path.splitext(dest)[1][1:],
+		os.path.abspath(src)], config['SCRIPT_DIR'], os.path.abspath(dest))
+
+def convert_plant(src, dest, config):
+	"""Converts a plant file using PlantUML (as a pipe, like the Makefile)."""
+	return ([config['JAVA'], '-jar', config['PLANTUML_JAR'],
+		'-t' + os.path.splitext(dest)[1][1:], '-pipe'], None, dest, src)
+
+def convert_plant_batch(srcs, ext, config):
+	"""Converts plant files using PlantUML (a single invocation)."""
+	return ([config['JAVA'], '-jar', config['PLANTUML_JAR'], '-t' + ext]
+		+ list(srcs), None, None)
+
+def can_batch_plant(src):
+	"""Checks if a plant file has a single diagram without a name, whose
+	output is named after the source when converted in a batch."""
+	try:
+		with open(src, 'r', errors='replace') as f:
+			names = PLANT_START_REGEX.findall(f.read())
+	except (IOError, OSError):
+		return False
+	return len(names) == 1 and not names[0].strip()
+
+def convert_svg(src, dest, config):
+	"""Converts an SVG file using inkscape or imagemagick."""
+	if shutil.which('inkscape') is None:
+		return (['convert', src, dest], None, None)
+	return (['inkscape', '--export-%s=%s' % (os.path.splitext(dest)[1][1:],
+		dest), src], None, None)
+
+def convert_tex(src, dest, config):
+	"""Compiles a tex file using pdflatex."""
+	return (['pdflatex'] + config['PDF_LATEX_FLAGS'].split()
+		+ ['-output-directory', os.path.dirname(dest) or os.curdir, src],
+		None, None)
+
+# Source extension: steps of (generated extension, conversion)
+CONVERSIONS = {
+	'dia': [('pdf', convert_dia)],
+	'dot': [('pdf', convert_dot)],
+	'java': [('dot', convert_java), ('pdf', convert_dot)],
+	'pic': [('svg', convert_pic), ('pdf', convert_svg)],
+	'plant': [('svg', convert_plant), ('pdf', convert_svg)],
+	'svg': [('pdf', convert_svg)],
+	'tex': [('pdf', convert_tex)],
+}
+# Conversions which accept several sources:
+# conversion -> (batch conversion, check if a source can be batched)
+BATCH_CONVERSIONS = {convert_plant: (convert_plant_batch, can_batch_plant)}
+
+def run(command, cwd=None, stdout=None, stdin=None, err=sys.stderr):
+	"""Runs a command, returns True on success."""
+	err.write('> %s%s\n' % (' '.join(command),
+		'' if stdin is None else ' < ' + stdin))
+	try:
+		with contextlib.ExitStack() as files:
+			if stdin is not None:
+				stdin = files.enter_context(open(stdin, 'rb'))
+			if stdout is not None:
+				stdout = files.enter_context(open(stdout, 'wb'))
+			return subprocess.call(command, cwd=cwd, stdin=stdin,
+				stdout=stdout) == 0
+	except OSError as ex:
+		err.write('%s: %s\n' % (command[0], ex))
+		return False
+
+# =========================================================
+
+class Fingerprints(object):
+	"""Hashes of the sources and the outputs of the last conversions."""
+
+	VERSION = 1
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.entries = {}
+		self.changed = False
+		self.load()
+
+	def load(self):
+		"""Loads the fingerprint file (ignored if invalid)."""
+		try:
+			with open(self.filename, 'r') as f:
+				data = json.load(f)
+		except (IOError, OSError, ValueError):
+			return
+		if isinstance(data, dict) and data.get('version') == self.VERSION:
+			self.entries = data.get('files', {})
+
+	def save(self):
+		"""Saves the fingerprint file if it changed."""
+		if not self.changed: return
+		tmp = self.filename + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'version': self.VERSION, 'files': self.entries}, f,
+				indent=0, sort_keys=True)
+		os.replace(tmp, self.filename)
+		self.changed = False
+
+	def is_up_to_date(self, src, dest):
+		"""Checks if dest was generated from the current src."""
+		entry = self.entries.get(dest)
+		if entry is None or not os.path.isfile(dest):
+			return False
+		if entry['source'] != hash_file(src):
+			return False
+		st = os.stat(dest)
+		if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+			return True
+		return entry['output'] == hash_file(dest)
+
+	def store(self, src, dest):
+		"""Stores the fingerprint of a conversion."""
+		st = os.stat(dest)
+		self.entries[dest] = {
+			'source': hash_file(src),
+			'output': hash_file(dest),
+			'size': st.st_size,
+			'mtime': st.st_mtime_ns,
+		}
+		self.changed = True
+
+def find_sources(directory=IMG_ROOT_DIR):
+	"""Lists the image sources in a directory (recursively)."""
+	sources = []
+	for root, dirs, files in os.walk(directory):
+		dirs.sort()
+		for name in sorted(files):
+			if os.path.splitext(name)[1][1:] in CONVERSIONS:
+				sources.append(os.path.join(root, name))
+	return sources
+
+def image_steps(src):
+	"""Gets the steps as (src, dest, conversion) to generate an image."""
+	base, ext = os.path.splitext(src)
+	steps = []
+	for gen_ext, conversion in CONVERSIONS[ext[1:]]:
+		steps.append((src, base + '.' + gen_ext, conversion))
+		src = base + '.' + gen_ext
+	return steps
+
+def remove_intermediate(sources):
+	"""Removes the sources generated from other sources (e.g. java -> dot)."""
+	generated = set(dest for src in sources for _, dest, _ in image_steps(src))
+	return [src for src in sources if src not in generated]
+
+def build_images(sources, config=None, jobs=None, fingerprints=None,
+		err=sys.stderr):
+	"""Builds the images generated from the sources.
+
+	Returns the list of (generated files, failed sources).
+	"""
+	if config is None:
+		config = DEFAULT_CONFIG
+	if jobs is None:
+		jobs = os.cpu_count() or 1
+	# images to generate
+	pending = []
+	for src in remove_intermediate(sources):
+		steps = image_steps(src)
+		dest = steps[-1][1]
+		if fingerprints is not None and fingerprints.is_up_to_date(src, dest):
+			continue
+		pending.append((src, steps))
+	generated = []
+	failed = []
+	def convert(src, steps):
+		for step_src, step_dest, conversion in steps:
+			if not run(*conversion(step_src, step_dest, config), err=err):
+				return False
+			generated.append(step_dest)
+		return True
+	def convert_batch(conversion, batch):
+		# returns the failed sources, the outputs which were not written by
+		# the batch are converted one by one
+		ext = os.path.splitext(batch[0][1][0][1])[1][1:]
+		mtime = lambda path: (os.stat(path).st_mtime_ns
+			if os.path.exists(path) else None)
+		before = dict((steps[0][1], mtime(steps[0][1])) for _, steps in batch)
+		if not run(*BATCH_CONVERSIONS[conversion][0](
+				[steps[0][0] for _, steps in batch], ext, config), err=err):
+			return set(src for src, _ in batch)
+		failed = set()
+		for src, steps in batch:
+			step_src, step_dest, _ = steps[0]
+			if mtime(step_dest) in [None, before[step_dest]] and not run(
+					*conversion(step_src, step_dest, config), err=err):
+				failed.add(src)
+			else:
+				generated.append(step_dest)
+		return failed
+	with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+		futures = {}
+		batches = {}
+		for src, steps in pending:
+			conversion = steps[0][2]
+			if (conversion in BATCH_CONVERSIONS
+					and BATCH_CONVERSIONS[conversion][1](src)):
+				batches.setdefault(conversion, []).append((src, steps))
+			else:
+				futures[pool.submit(convert, src, steps)] = [src]
+		for conversion, batch in batches.items():
+			futures[pool.submit(convert_batch, conversion, batch)] = batch
+		while futures:
+			done, _ = concurrent.futures.wait(futures,
+				return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				batch = futures.pop(future)
+				if isinstance(batch[0], tuple):
+					# continue the batched sources
+					batch_failed = future.result()
+					for src, steps in batch:
+						if src not in batch_failed:
+							futures[pool.submit(convert, src, steps[1:])] = [src]
+						else:
+							failed.append(src)
+					continue
+				src = batch[0]
+				if not future.result():
+					failed.append(src)
+				elif fingerprints is not None:
+					fingerprints.store(src, image_steps(src)[-1][1])
+	return generated, failed
+
+def main():
+	"""The main program.
+
+	Usage: [--cache file] [-j jobs] [--log file] [NAME=value...] [sources]
+
+	--cache sets the fingerprint file (default: FINGERPRINT_FILE)
+	-j runs the conversions on a pool of jobs workers (default: cpu count)
+	--log appends the generated files to a file
+	NAME=value sets a variable (see DEFAULT_CONFIG)
+	The sources are found in IMG_ROOT_DIR if none is given.
+	"""
+	config = dict(DEFAULT_CONFIG)
+	cache = FINGERPRINT_FILE
+	jobs = None
+	log = None
+	sources = []
+	args = iter(sys.argv[1:])
+	for arg in args:
+		if arg == '--cache':
+			cache = next(args, cache)
+		elif arg == '-j':
+			jobs = int(next(args, 1))
+		elif arg == '--log':
+			log = next(args, None)
+		elif '=' in arg and arg.split('=', 1)[0] in config:
+			name, value = arg.split('=', 1)
+			config[name] = value
+		else:
+			sources.append(arg)
+	if not sources:
+		sources = find_sources()
+	fingerprints = Fingerprints(cache)
+	try:
+		generated, failed = build_images(sources, config=config, jobs=jobs,
+			fingerprints=fingerprints)
+	finally:
+		fingerprints.save()
+	if log is not None and generated:
+		with open(log, 'a') as f:
+			for path in generated:
+				f.write(path + '\n')
+	for src in failed:
+		sys.stderr.write('Failed: %s\n' % src)
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -3,19 +3,35 @@
 Script for merging latex-base directories
 """
 
+import collections
+import concurrent.futures
+import fnmatch
 import hashlib
+import json
 import os
 import os.path
-import re
 import shutil
 import subprocess
 import sys
+import threading
+
+import doc_depgen
+import doc_discover
+
+HASH_BLOCK_SIZE = 1 << 16
+MANIFEST_FILE = '.latex-base-manifest'
+IGNORED_FILES = ['__pycache__', '*.pyc']
+SYNC_JOBS = 8
+CONFLICT_POLICIES = ['skip', 'overwrite']
 
 def prompt(message='Input:', choice=None, default=None):
 	""" Prompts a user to enter some text."""
 	while True:
-		print(message, end=' ')
+		print(message, end=' ', flush=True)
 		response = sys.stdin.readline()
+		if len(response) == 0 and default is None:
+			raise EOFError()
+		response = response.strip()
 		if choice is not None:
 			response = response.lower()
 			if (len(response) == 0
@@ -55,9 +71,93 @@ def get_base_directory():
 	return path
 
 def hash_file(path):
-	""" Returns a hash of a file. """
+	""" Returns a hash of a file (read by blocks). """
+	digest = hashlib.md5()
 	with open(path, 'rb') as f:
-		return hashlib.md5(f.read()).hexdigest()
+		for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+class HashManifest(object):
+	"""
+	Digests of files stored in a directory (MANIFEST_FILE).
+	A file is hashed again only when its size or mtime changed.
+	"""
+	VERSION = 1
+
+	def __init__(self, directory):
+		self.directory = os.path.abspath(directory)
+		self.filename = os.path.join(self.directory, MANIFEST_FILE)
+		self.entries = {}
+		self.changed = False
+		self.lock = threading.Lock()
+		self.load()
+
+	def load(self):
+		""" Loads the manifest (ignored if invalid). """
+		try:
+			with open(self.filename, 'r') as f:
+				data = json.load(f)
+		except (IOError, OSError, ValueError):
+			return
+		if isinstance(data, dict) and data.get('version') == self.VERSION:
+			self.entries = data.get('files', {})
+
+	def save(self):
+		""" Saves the manifest if it changed. """
+		if not self.changed or not os.path.isdir(self.directory): return
+		tmp = self.filename + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'version': self.VERSION, 'files': self.entries}, f,
+				indent=0, sort_keys=True)
+		os.replace(tmp, self.filename)
+		self.changed = False
+
+	def key(self, path):
+		""" Key of a file: relative to the directory if inside. """
+		path = os.path.abspath(path)
+		rel = os.path.relpath(path, self.directory)
+		return path if rel.startswith(os.pardir) else rel
+
+	def hash(self, path):
+		""" Returns a hash of a file. """
+		st = os.stat(path)
+		key = self.key(path)
+		with self.lock:
+			entry = self.entries.get(key)
+		if (entry is not None
+			and entry['size'] == st.st_size
+			and entry['mtime'] == st.st_mtime_ns):
+			return entry['hash']
+		digest = hash_file(path)
+		self.store(path, st, digest,
+			synced=None if entry is None else entry.get('synced'))
+		return digest
+
+	def store(self, path, st, digest, synced=None):
+		""" Stores the digest of a file and the last copied digest. """
+		entry = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'hash': digest}
+		if synced is not None:
+			entry['synced'] = synced
+		with self.lock:
+			self.entries[self.key(path)] = entry
+			self.changed = True
+
+	def copied(self, path, digest):
+		""" Records that a file was copied with the given digest. """
+		self.store(path, os.stat(path), digest, synced=digest)
+
+	def synced(self, path):
+		""" Returns the digest of the file when it was last copied. """
+		with self.lock:
+			entry = self.entries.get(self.key(path))
+		return None if entry is None else entry.get('synced')
+
+def file_hash(path, manifest=None):
+	""" Returns a hash of a file using the manifest if given. """
+	if manifest is None:
+		return hash_file(path)
+	return manifest.hash(path)
 
 # ----------------------------------------------------------------------------
 
@@ -66,31 +166,193 @@ class AbortException(Exception):
 	def __init__(self, message='Aborted'):
 		Exception.__init__(self, message)
 
-def dir_update(dest, recursive_src=None, optional=False, ask=False):
-	""" Updates a directory. """
-	if not os.path.isdir(recursive_src) and optional:
-		return
-	if not os.path.isdir(dest):
-		if ask and not confirm("Copy the directory '%s'?" % recursive_src,
-				default=True):
-			return
-		print('Creating directory: %s' % dest)
-		os.mkdir(dest)
-	if recursive_src is None:
-		return
-	for f in os.listdir(recursive_src):
-		f_dest = os.path.join(dest, f)
-		f_src = os.path.join(recursive_src, f)
-		if os.path.isfile(f_src):
-			file_update(f_dest, f_src)
-		elif os.path.isdir(f_src):
-			dir_update(f_dest, f_src)
-
-def file_update(dest, src, only_create=False, optional=False):
+# A change computed while planning an update
+# action: mkdir, create, update (the destination was not modified since it
+# was copied), conflict (the destination was modified) or skip
+# ask: the directory to confirm before copying (or None)
+Change = collections.namedtuple('Change', ['action', 'dest', 'src', 'ask'])
+
+def is_ignored(name):
+	""" Checks if a file is ignored when copying directories. """
+	return any(fnmatch.fnmatch(name, pattern) for pattern in IGNORED_FILES)
+
+def plan_dir(changes, files, dest, src, optional=False, ask=False):
+	"""
+	Walks a directory with os.scandir.
+	Appends the directories to create to changes and the files to compare
+	to files as (dest, src, ask).
+	"""
+	if not os.path.isdir(src):
+		if optional: return
+		raise AbortException('Source is not a directory: %s' % src)
+	ask = src if ask and not os.path.isdir(dest) else None
+	stack = [(dest, src)]
+	while stack:
+		dest, src = stack.pop()
+		if not os.path.isdir(dest):
+			changes.append(Change('mkdir', dest, src, ask))
+		with os.scandir(src) as entries:
+			for entry in sorted(entries, key=lambda e: e.name):
+				if is_ignored(entry.name): continue
+				f_dest = os.path.join(dest, entry.name)
+				if entry.is_file():
+					files.append((f_dest, entry.path, ask))
+				elif entry.is_dir():
+					stack.append((f_dest, entry.path))
+
+def plan_file(dest, src, only_create=False, optional=False, manifest=None):
+	"""
+	Computes the action to update a single file.
+	If only_create is True, nothing happens if the destination file already
+	exists.
+	"""
+	if not os.path.isfile(src):
+		if optional: return 'skip'
+		raise AbortException('Source is not a file: %s' % src)
+	if not os.path.exists(dest):
+		return 'create'
+	if (only_create
+		or os.path.isdir(dest)
+		or os.path.getmtime(dest) >= os.path.getmtime(src)):
+		return 'skip'
+	digest = file_hash(dest, manifest)
+	if digest == file_hash(src, manifest):
+		return 'skip'
+	if manifest is not None and manifest.synced(dest) == digest:
+		return 'update'
+	return 'conflict'
+
+def plan_update(dest, src, manifest=None, jobs=SYNC_JOBS, interactive=True):
+	"""
+	Computes the list of changes to update dest from src.
+	The files are compared concurrently by a pool of threads.
+	interactive: whether to ask to continue if src is not a latex-base
+	directory (aborts otherwise)
+	"""
+	if interactive:
+		check_latex_base_directory(src)
+	elif not check_latex_base_directory(src, brep=True):
+		raise AbortException("'%s' is not a latex-base directory" % src)
+	changes = []
+	files = [] # (dest, src, ask, only_create, optional)
+	def add_dir(f, **kwargs):
+		dir_files = []
+		plan_dir(changes, dir_files, os.path.join(dest, f),
+			os.path.join(src, f), **kwargs)
+		files.extend(entry + (False, False) for entry in dir_files)
+	# Directories
+	for f in ['script']:
+		add_dir(f)
+	# Files
+	for f in ['Makefile']:
+		files.append((os.path.join(dest, f), os.path.join(src, f), None,
+			False, False))
+	# Optional directories
+	for f in ['input']:
+		add_dir(f, optional=True, ask=True)
+	# Optional files
+	for f in ['Makefile.files', '.gitignore', '.hgignore']:
+		files.append((os.path.join(dest, f), os.path.join(src, f), None,
+			True, True))
+	with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+		actions = pool.map(
+			lambda f: plan_file(f[0], f[1], only_create=f[3], optional=f[4],
+				manifest=manifest),
+			files)
+		for f, action in zip(files, actions):
+			changes.append(Change(action, f[0], f[1], f[2]))
+	return changes
+
+def print_changes(changes):
+	""" Prints the changes (except the skipped files). """
+	counts = collections.Counter(change.action for change in changes)
+	for change in changes:
+		if change.action == 'skip': continue
+		print('%-8s %s' % (change.action, change.dest))
+	print(', '.join('%s: %d' % (action, counts[action])
+		for action in ['mkdir', 'create', 'update', 'conflict', 'skip']))
+
+def show_diff(dest, src):
+	""" Shows the difference between two files. """
+	pdiff = subprocess.Popen(['diff', '-u', dest, src],
+		stdout=subprocess.PIPE)
+	pless = subprocess.Popen(['less'],
+		stdin=pdiff.stdout)
+	pdiff.stdout.close() # allow diff to receive SIGPIPE
+	pless.wait()
+
+def confirm_changes(changes, policy=None):
+	"""
+	Asks for the directories to copy and the conflicts to overwrite.
+	When a policy is given (see CONFLICT_POLICIES), nothing is asked: the
+	directories are copied and the conflicts are skipped or overwritten.
+	Returns the changes to apply.
+	"""
+	# Directories
+	asked = set(change.ask for change in changes if change.ask is not None)
+	refused = set()
+	for directory in sorted(asked):
+		if policy is None and not confirm(
+			"Copy the directory '%s'?" % directory, default=True):
+			refused.add(directory)
+	changes = [change for change in changes
+		if change.action != 'skip' and change.ask not in refused]
+	# Conflicts
+	conflicts = [change for change in changes if change.action == 'conflict']
+	if not conflicts:
+		return changes
+	print('Files modified in the destination:')
+	for change in conflicts:
+		print('  %s' % change.dest)
+	if policy is not None:
+		overwrite = policy == 'overwrite'
+	else:
+		overwrite = prompt("Overwrite them? [all/none/each/quit]",
+			default='each',
+			choice={'all': True, 'a': True, 'none': False, 'n': False,
+				'each': None, 'e': None, 'quit': 'quit', 'q': 'quit'})
+	if overwrite == 'quit':
+		raise AbortException()
+	if overwrite is None:
+		overwrite = set()
+		for change in conflicts:
+			print("File already exists: %s" % change.dest)
+			if confirm("Show diff?", default=False):
+				show_diff(change.dest, change.src)
+			if confirm("Overwrite the file?"):
+				overwrite.add(change)
+		return [change for change in changes
+			if change.action != 'conflict' or change in overwrite]
+	if overwrite:
+		return changes
+	return [change for change in changes if change.action != 'conflict']
+
+def apply_changes(changes, manifest=None, jobs=SYNC_JOBS):
+	""" Applies the changes, the files are copied by a pool of threads. """
+	for change in changes:
+		if change.action != 'mkdir': continue
+		print('Creating directory: %s' % change.dest)
+		os.makedirs(change.dest, exist_ok=True)
+	def copy(change):
+		destdir = os.path.dirname(change.dest)
+		if not os.path.exists(destdir):
+			os.makedirs(destdir, exist_ok=True)
+		shutil.copyfile(change.src, change.dest)
+		if manifest is not None:
+			manifest.copied(change.dest, file_hash(change.src, manifest))
+		return change.dest
+	files = [change for change in changes if change.action != 'mkdir']
+	with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+		for dest in pool.map(copy, files):
+			print('Updating file: %s' % dest)
+
+def file_update(dest, src, only_create=False, optional=False,
+		manifest=None):
 	"""
 	Updates a single file.
 	If only_create is True, nothing happens if the destination file already
 	exists.
+	The hashes are taken from the manifest (a HashManifest) if given.
 	"""
 	if not os.path.isfile(src):
 		if optional: return False
@@ -99,16 +361,11 @@ def file_update(dest, src, only_create=False, optional=False):
 		if (only_create
 			or os.path.isdir(dest)
 			or os.path.getmtime(dest) >= os.path.getmtime(src)
-			or hash_file(dest) == hash_file(src)):
+			or file_hash(dest, manifest) == file_hash(src, manifest)):
 			return False
 		print("File already exists: %s" % dest)
 		if confirm("Show diff?", default=False):
-			pdiff = subprocess.Popen(['diff', '-u', dest, src],
-				stdout=subprocess.PIPE)
-			pless = subprocess.Popen(['less'],
-				stdin=pdiff.stdout)
-			pdiff.stdout.close() # allow diff to receive SIGPIPE
-			pless.wait()
+			show_diff(dest, src)
 		if not confirm("Overwrite the file?"):
 			raise AbortException()
 	print('Updating file: %s' % dest)
@@ -133,78 +390,34 @@ def check_latex_base_directory(path, brep=False):
 			raise AbortException()
 	if brep: return True
 
-def update_files(dest, src):
-	""" Updates the files by copying what is necessary """
-	check_latex_base_directory(src)
-	# Directories
-	for f in ['script']:
-		dir_update(os.path.join(dest, f), os.path.join(src, f))
-	# Files
-	for f in ['Makefile']:
-		file_update(os.path.join(dest, f), os.path.join(src, f))
-	# Optional directories
-	for f in ['input']:
-		dir_update(os.path.join(dest, f), os.path.join(src, f),
-			optional=True, ask=True)
-	# Optional files
-	for f in ['Makefile.files', '.gitignore', '.hgignore']:
-		file_update(os.path.join(dest, f), os.path.join(src, f),
-			only_create=True, optional=True)
-
-def read_make_files(filename, prefix):
-	""" Reads files from a Makefile file which are entered as dependencies """
-	with open(filename, 'r') as f:
-		return read_make_files_all(f, prefix)[0]
-
-def read_make_files_all(f, prefix):
+def update_files(dest, src, manifest=None, dry_run=False, policy=None):
 	"""
-	Reads files from a Makefile file prefixed by a variable name.
-	Returns a tuple with: (files, lines_before, lines_after)
+	Updates the files by copying what is necessary.
+	The changes are planned, confirmed in one batch and then applied.
+	dry_run: only print the changes
+	policy: conflict policy when not interactive (see confirm_changes)
 	"""
-	reading = 0
-	lines_before = []
-	lines_after = []
-	files = []
-	for line in f:
-		if reading == 1:
-			pass
-		elif line.startswith(prefix):
-			line = line[len(prefix):]
-			reading = 1
-		else:
-			if reading == 0:
-				lines_before.append(line)
-			else:
-				lines_after.append(line)
-			continue
-		line = line.rstrip()
-		cont = False
-		if line[-1:] == "\\":
-			cont = True
-			line = line.rstrip("\\")
-		fname = ''
-		for n in line.split():
-			fname += n
-			if fname[-1:] == "\\":
-				fname = fname[:len(fname) - 1] + ' '
-			else:
-				files.append(fname)
-				fname = ''
-		if not cont:
-			reading = 2
-	return (files, lines_before, lines_after)
+	changes = plan_update(dest, src, manifest=manifest,
+		interactive=policy is None)
+	if dry_run:
+		print_changes(changes)
+		return
+	changes = confirm_changes(changes, policy=policy)
+	apply_changes(changes, manifest=manifest)
 
 def list_templates(directory):
-	""" Lists template files declared in Makefile.files """
-	proc = subprocess.Popen(['make', 'debug-DOC'],
-			cwd=directory,
-			stdout=subprocess.PIPE)
-	proc.poll()
-	result = proc.communicate()[0].decode("utf-8")
-	for line in result.splitlines():
-		if not line.startswith("DOC="): continue
-		return re.split('\\s+', line[4:].strip())
-	return [] # not found
+	""" Lists template files (documents found as DOC_AUTOFIND) """
+	return doc_discover.find_documents(directory)
+
+def template_dependencies(name, directory):
+	""" Lists the dependencies of a template file """
+	cwd = os.getcwd()
+	os.chdir(directory)
+	try:
+		deps = doc_depgen.find_dependencies(name)
+	finally:
+		os.chdir(cwd)
+	return sorted(deps or [])
 
 def update_template(name, dest, src, deps=None):
 	""" Updates a template file """
@@ -220,35 +433,44 @@ def update_template(name, dest, src, deps=None):
 	if deps is None:
 		deps = confirm("Copy dependencies?", default=True)
 	if deps:
-		# Make depend
-		print('> make depend (cwd: %s)' % src)
-		subprocess.check_call(['make', 'depend'], cwd=src)
-		print('')
-		# Update dependencies
-		for path in read_make_files(os.path.join(src, 'Makefile.d'),
-			os.path.splitext(name)[0] + '.pdf:'):
+		for path in template_dependencies(name, src):
 			if path == name: continue
-			file_update(os.path.join(dest, path), os.path.join(src, path))
+			file_update(os.path.join(dest, path), os.path.join(src, path),
+				optional=True)
 
 # ----------------------------------------------------------------------------
 
-def command_init(path='', base=get_base_directory()):
+def command_init(path='', base=get_base_directory(),
+		dry_run=False, policy=None):
 	""" Command: init """
 	path = os.path.join(os.getcwd(), path)
 	exists = os.path.exists(path)
-	if (exists and
+	if (exists and policy is None and
 		not confirm("Directory '%s' already exists, continue?" % path,
 			default=False)):
 		raise AbortException("'%s' already exists." % path)
-	if not exists: os.mkdir(path)
-	update_files(path, base)
+	if not exists and not dry_run: os.mkdir(path)
+	manifest = HashManifest(path)
+	try:
+		update_files(path, base, manifest=manifest,
+			dry_run=dry_run, policy=policy)
+	finally:
+		if not dry_run: manifest.save()
 	print('Done.')
 
-def command_update(base=get_base_directory()):
+def command_update(base=get_base_directory(), dry_run=False, policy=None):
 	""" Command: update """
 	path = os.getcwd()
-	check_latex_base_directory(path)
-	update_files(path, base)
+	if policy is None:
+		check_latex_base_directory(path)
+	elif not check_latex_base_directory(path, brep=True):
+		raise AbortException("'%s' is not a latex-base directory" % path)
+	manifest = HashManifest(path)
+	try:
+		update_files(path, base, manifest=manifest,
+			dry_run=dry_run, policy=policy)
+	finally:
+		if not dry_run: manifest.save()
 	print('Done.')
 
 def command_template(name='', base=get_base_directory()):
@@ -283,23 +505,46 @@ def main():
 	def usage():
 		""" Usage """
 		script_name = os.path.basename(sys.argv[0])
-		print('Usage: %s init [PATH] [BASE]' % script_name)
-		print('       %s update [BASE]' % script_name)
+		print('Usage: %s init [OPTIONS] [PATH] [BASE]' % script_name)
+		print('       %s update [OPTIONS] [BASE]' % script_name)
 		print('       %s template [NAME] [BASE]' % script_name)
 		print('')
 		print(' init: creates a new repository PATH from BASE')
 		print(' update: updates files in the current folder from BASE')
 		print(' template: copies a template file')
 		print('')
+		print('Options:')
+		print(' --dry-run: prints the changes without applying them')
+		print(' --non-interactive[=skip|overwrite]: does not ask anything,')
+		print('   skips (default) or overwrites the modified files')
+		print('')
 		print(' BASE=' + get_base_directory())
 	if len(sys.argv) < 2:
 		usage()
 		sys.exit(1)
 	command = sys.argv[1]
+	args = []
+	kwargs = {}
+	for arg in sys.argv[2:]:
+		if arg == '--dry-run':
+			kwargs['dry_run'] = True
+		elif arg.startswith('--non-interactive'):
+			policy = arg[len('--non-interactive='):] or 'skip'
+			if policy not in CONFLICT_POLICIES:
+				print("Invalid policy '%s'" % policy)
+				sys.exit(1)
+			kwargs['policy'] = policy
+		else:
+			args.append(arg)
+	if command == 'template' and kwargs:
+		print("The options are not supported by 'template'")
+		print('')
+		usage()
+		sys.exit(1)
 	if command in ['init', 'update', 'template']:
-		command = locals()['command_' + command]
+		command = globals()['command_' + command]
 		try:
-			command(*sys.argv[2:])
+			command(*args, **kwargs)
 		except TypeError as ex:
 			print(ex)
 			sys.exit(1)
@@ -309,6 +554,9 @@ def main():
 		except KeyboardInterrupt:
 			print(' > Interrupted')
 			sys.exit(1)
+		except EOFError:
+			print(' > No input (see --non-interactive)')
+			sys.exit(1)
 		else:
 			sys.exit(0)
 	else:
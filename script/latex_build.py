@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+Compiles a tex document using pdflatex, running only the needed passes:
+
+- another pass runs only when a file read back by LaTeX (aux, toc, lof...)
+  changed during the last one; the "rerun" messages of the log, printed
+  conservatively by the packages, are ignored
+- bibtex (or biber), makeindex and makeglossaries run only when their
+  input changed: the citations and the bib files, the idx file, the
+  glo/acn files
+
+The hashes of the inputs of the tools are kept in <document>.fdb_build.
+"""
+
+import json
+import os
+import os.path
+import re
+import subprocess
+import sys
+
+import img_build
+
+STATE_EXT = 'fdb_build'
+MAX_PASSES = 5
+# Passes of the Makefile rule when the log asks to rerun
+LOG_RULE_PASSES = 3
+
+# Files written by pdflatex and read by the next pass
+AUX_EXT = ['aux', 'bbl', 'toc', 'lof', 'lot', 'loa', 'nav', 'snm', 'out',
+	'ind', 'gls', 'acr']
+
+DEFAULT_CONFIG = {
+	'PDF_LATEX_FLAGS': img_build.DEFAULT_CONFIG['PDF_LATEX_FLAGS'],
+}
+
+AUX_INPUT_REGEX = re.compile(r'\\@input\{([^}]+)\}')
+AUX_BIB_REGEX = re.compile(r'\\(citation|bibdata|bibstyle)\{([^}]*)\}')
+BCF_DATASOURCE_REGEX = re.compile(
+	r'<bcf:datasource[^>]*>([^<]+)</bcf:datasource>')
+LOG_RERUN_REGEX = re.compile(
+	r'There were undefined references|rerun to get', re.IGNORECASE)
+
+def hash_files(paths):
+	"""Gets a hash of the existing files (None if none exists)."""
+	digests = ['%s:%s' % (path, img_build.hash_file(path))
+		for path in paths if os.path.isfile(path)]
+	return ' '.join(digests) or None
+
+def is_nonempty(path):
+	"""Checks if a file exists and is not empty."""
+	return os.path.isfile(path) and os.path.getsize(path) > 0
+
+def aux_files(base):
+	"""Lists the aux file of a document and those it inputs (\\include)."""
+	directory = os.path.dirname(base)
+	pending = [base + '.aux']
+	found = []
+	while pending:
+		aux = pending.pop()
+		if aux in found or not os.path.isfile(aux): continue
+		found.append(aux)
+		with open(aux, 'r', errors='replace') as f:
+			for match in AUX_INPUT_REGEX.finditer(f.read()):
+				pending.append(os.path.join(directory, match.group(1)))
+	return found
+
+def aux_fingerprints(base):
+	"""Gets the hashes of the files read back by pdflatex."""
+	paths = set(aux_files(base))
+	paths.update(base + '.' + ext for ext in AUX_EXT)
+	return dict((path, img_build.hash_file(path))
+		for path in paths if os.path.isfile(path))
+
+def find_bib(name, base):
+	"""Finds a bib file relative to the document or the current directory."""
+	if not name.endswith('.bib'):
+		name += '.bib'
+	for path in [os.path.join(os.path.dirname(base), name), name]:
+		if os.path.isfile(path):
+			return path
+	return None
+
+# =========================================================
+# Tools: each function returns (input hash, command, output file)
+# the input hash is None when the tool is not needed
+
+def bibliography_tool(base):
+	"""Gets the bibtex or biber run of a document."""
+	bcf = base + '.bcf'
+	if is_nonempty(bcf):
+		with open(bcf, 'r', errors='replace') as f:
+			names = BCF_DATASOURCE_REGEX.findall(f.read())
+		bibs = [find_bib(name.strip(), base) for name in names]
+		return (hash_files([bcf] + [bib for bib in bibs if bib]),
+			['biber', base], base + '.bbl')
+	entries = []
+	bibs = []
+	for aux in aux_files(base):
+		with open(aux, 'r', errors='replace') as f:
+			for match in AUX_BIB_REGEX.finditer(f.read()):
+				entries.append(match.group(0))
+				if match.group(1) == 'bibdata':
+					bibs.extend(find_bib(name.strip(), base)
+						for name in match.group(2).split(','))
+	if not entries:
+		return None, None, None
+	digest = '%s %s' % (' '.join(entries),
+		hash_files(sorted(set(bib for bib in bibs if bib))))
+	return digest, ['bibtex', base], base + '.bbl'
+
+def index_tool(base):
+	"""Gets the makeindex run of a document."""
+	idx = base + '.idx'
+	if not is_nonempty(idx):
+		return None, None, None
+	return hash_files([idx]), ['makeindex', idx], base + '.ind'
+
+def glossaries_tool(base):
+	"""Gets the makeglossaries run of a document."""
+	inputs = [base + '.glo', base + '.acn']
+	if not any(is_nonempty(path) for path in inputs):
+		return None, None, None
+	return (hash_files(inputs + [base + '.ist']), ['makeglossaries', base],
+		base + '.gls')
+
+TOOLS = [
+	('bibliography', bibliography_tool),
+	('index', index_tool),
+	('glossaries', glossaries_tool),
+]
+# Exit codes of the tools which report warnings (e.g. a missing field)
+WARNING_CODES = {'bibtex': [1]}
+
+def run_command(command, quiet=False, err=sys.stderr):
+	"""Runs a command, returns its exit code (None if it cannot run)."""
+	err.write('> %s\n' % ' '.join(command))
+	try:
+		return subprocess.call(command,
+			stdout=subprocess.DEVNULL if quiet else None)
+	except OSError as ex:
+		err.write('%s: %s\n' % (command[0], ex))
+		return None
+
+# =========================================================
+
+class BuildState(object):
+	"""Hashes of the inputs of the tools when they last ran."""
+
+	VERSION = 1
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.entries = {}
+		self.changed = False
+		self.load()
+
+	def load(self):
+		"""Loads the state file (ignored if invalid)."""
+		try:
+			with open(self.filename, 'r') as f:
+				data = json.load(f)
+		except (IOError, OSError, ValueError):
+			return
+		if isinstance(data, dict) and data.get('version') == self.VERSION:
+			self.entries = data.get('tools', {})
+
+	def save(self):
+		"""Saves the state file if it changed."""
+		if not self.changed: return
+		tmp = self.filename + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'version': self.VERSION, 'tools': self.entries}, f,
+				indent=0, sort_keys=True)
+		os.replace(tmp, self.filename)
+		self.changed = False
+
+	def is_up_to_date(self, name, digest, output):
+		"""Checks if a tool already ran on the same input."""
+		return os.path.isfile(output) and self.entries.get(name) == digest
+
+	def store(self, name, digest):
+		"""Stores the input of a tool after it ran."""
+		self.entries[name] = digest
+		self.changed = True
+
+def run_tools(base, state, quiet=False, err=sys.stderr):
+	"""Runs the tools whose input changed.
+
+	Returns (names of the tools run, names of the tools skipped, success).
+	"""
+	ran = []
+	skipped = []
+	for name, tool in TOOLS:
+		digest, command, output = tool(base)
+		if digest is None:
+			continue
+		if state.is_up_to_date(name, digest, output):
+			skipped.append(command[0])
+			continue
+		code = run_command(command, quiet=quiet, err=err)
+		if code in WARNING_CODES.get(command[0], []):
+			err.write('%s: warnings (exit code %d)\n' % (command[0], code))
+		elif code != 0:
+			return ran, skipped, False
+		state.store(name, digest)
+		ran.append(command[0])
+	return ran, skipped, True
+
+def log_asks_rerun(base):
+	"""Checks if the log asks for another pass (heuristic of the Makefile)."""
+	try:
+		with open(base + '.log', 'r', errors='replace') as f:
+			return LOG_RERUN_REGEX.search(f.read()) is not None
+	except (IOError, OSError):
+		return False
+
+def build_document(tex, config=None, max_passes=MAX_PASSES, quiet=False,
+		err=sys.stderr):
+	"""Compiles a tex document, running pdflatex until the aux files are
+	stable.
+
+	Returns a report: passes, saved (passes the log heuristic would have
+	added), tools run and skipped, success. The pdf is removed when the
+	compilation or a tool fails.
+	"""
+	if config is None:
+		config = DEFAULT_CONFIG
+	base = os.path.splitext(tex)[0]
+	state = BuildState(base + '.' + STATE_EXT)
+	report = {'passes': 0, 'saved': 0, 'ran': [], 'skipped': [],
+		'success': False}
+	before = aux_fingerprints(base)
+	try:
+		while True:
+			command = img_build.convert_tex(tex, base + '.pdf', config)
+			report['passes'] += 1
+			if run_command(command[0], quiet=quiet, err=err) != 0:
+				return report
+			ran, skipped, ok = run_tools(base, state, quiet=quiet, err=err)
+			report['ran'].extend(ran)
+			report['skipped'].extend(name for name in skipped
+				if name not in report['skipped'])
+			if not ok:
+				return report
+			after = aux_fingerprints(base)
+			changed = sorted(path for path in set(before) | set(after)
+				if before.get(path) != after.get(path))
+			if not changed:
+				if log_asks_rerun(base):
+					report['saved'] = max(0, LOG_RULE_PASSES - report['passes'])
+				break
+			if report['passes'] >= max_passes:
+				err.write('%s: still changing after %d passes: %s\n'
+					% (tex, report['passes'], ' '.join(changed)))
+				break
+			err.write('Rerun (changed: %s)\n' % ' '.join(changed))
+			before = after
+		report['success'] = True
+	finally:
+		state.save()
+		if not report['success'] and os.path.exists(base + '.pdf'):
+			os.remove(base + '.pdf')
+	return report
+
+def main():
+	"""The main program.
+
+	Usage: [--max-passes n] [--quiet] [NAME=value...] document.tex
+
+	--max-passes sets the maximum number of pdflatex passes
+	(default: MAX_PASSES)
+	--quiet discards the output of pdflatex and the tools
+	NAME=value sets a variable (see DEFAULT_CONFIG)
+	"""
+	config = dict(DEFAULT_CONFIG)
+	max_passes = MAX_PASSES
+	quiet = False
+	documents = []
+	args = iter(sys.argv[1:])
+	for arg in args:
+		if arg == '--max-passes':
+			max_passes = int(next(args, max_passes))
+		elif arg == '--quiet':
+			quiet = True
+		elif '=' in arg and arg.split('=', 1)[0] in config:
+			name, value = arg.split('=', 1)
+			config[name] = value
+		else:
+			documents.append(arg)
+	if not documents:
+		sys.stderr.write("Usage: [--max-passes n] [--quiet] [NAME=value...]"
+			" document.tex\n")
+		sys.exit(1)
+	failed = False
+	for tex in documents:
+		report = build_document(tex, config=config, max_passes=max_passes,
+			quiet=quiet)
+		sys.stderr.write('%s: %d pdflatex pass(es), %d saved' % (
+			tex, report['passes'], report['saved']))
+		if report['skipped']:
+			sys.stderr.write(', skipped: %s' % ' '.join(report['skipped']))
+		sys.stderr.write('\n')
+		failed = failed or not report['success']
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
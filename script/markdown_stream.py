@@ -8,17 +8,49 @@ Uses concatenation for documents imported using:
 
 """
 
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
 import os.path
+import queue
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 
 MD_EXT = ['md', 'markdown', 'mkdn', 'mdown']
 HEADER_LINES = ['title', 'author', 'date']
+BLOCK_SIZE = 1 << 16
+PIPE_BUFFER_SIZE = 1 << 20
+PIPE_QUEUE_SIZE = 64
+FRAGMENT_CACHE_SIZE = 1 << 26
+# replaced by the output file of each document in batch mode
+BATCH_TARGET = '{target}'
+# an example of reference: ![some text](url "optional description")
+INCLUDE_REGEX = re.compile(r'!\[[^]]+\]\(([^)]+?)(?:\s+["\'][^)]*["\'])?\)')
+# Fixes of the LaTeX generated by pandoc: (regex, replacement)
+LATEX_FIXES = [(re.compile(regex), replacement) for regex, replacement in [
+	# enumerate labels for the enumitem package
+	(r'(begin\{enumerate})\[(.)?1(.)?]', r'\1[label=\2\\arabic*\3]'),
+	(r'(begin\{enumerate})\[(.)?a(.)?]', r'\1[label=\2\\alph*\3]'),
+	(r'(begin\{enumerate})\[(.)?A(.)?]', r'\1[label=\2\\Alph*\3]'),
+	(r'(begin\{enumerate})\[(.)?i(.)?]', r'\1[label=\2\\roman*\3]'),
+	(r'(begin\{enumerate})\[(.)?I(.)?]', r'\1[label=\2\\Roman*\3]'),
+	(r'(begin\{enumerate})\[.{1,3}]', r'\1'),
+	# listings use the styles defined for each language
+	(r'(begin\{lstlisting})\[language=(\w+)]', r'\1[style=\2]'),
+]]
 
 def copy_markdown(out, filename,
 		copy_header=False,
 		recursion=None,
-		err=sys.stderr):
+		err=sys.stderr,
+		block_size=BLOCK_SIZE,
+		deps=None):
 	"""Copies the markdown file to the output stream.
 
 	out: the output stream
@@ -26,44 +58,78 @@ def copy_markdown(out, filename,
 	copy_header=False: whether to copy the header to the output
 	recursion=None: array of function to copy recursively
 	err=sys.stderr: stream to print error messages
+	block_size=BLOCK_SIZE: size of the blocks read from the file
+	deps=None: set receiving the files read and the files referenced
 
 	The recursion a dictionary of str extensions to functions applied when an
 	extension matches. A default function can be given for an extension ''.
 	If None is given, it is initialized using RECURSION_FUNCTIONS.
+	When deps is given, it is passed to the recursion functions.
 	"""
 	err.write("Reading markdown: %s\n" % filename)
 	if recursion is None:
 		recursion = RECURSION_FUNCTIONS
+	if deps is not None:
+		deps.add(filename)
 	try:
 		with open(filename, 'r') as f:
-			header = len(HEADER_LINES) if copy_header else None
-			for line in f:
-				if header is not None:
-					if line.strip().startswith('%'):
-						if header > 0: out.write(line)
-						header -= 1
-						continue
-					else:
-						header = None
-				m = re.search(r'!\[[^]]+\]\(([^)]+)(?:\s["\'].*["\'])?\)',
-						line)
-				if m is not None and m.group(1).find("://") < 0:
-					ref = m.group(1)
-					ext = os.path.splitext(ref)[1][1:]
-					if ext in recursion or '' in recursion:
-						out.write(line[:m.start()])
-						recfunc = recursion[ext] if ext in recursion else recursion['']
-						recfunc(out, ref, recursion=recursion, err=err)
-						out.write(line[m.end():])
-						continue
-					else:
-						err.write("Included file (as is): %s\n" % ref)
-				out.write(line)
+			line = ''
+			if copy_header:
+				header = len(HEADER_LINES)
+				for line in iter(f.readline, ''):
+					if not line.strip().startswith('%'):
+						break
+					if header > 0: out.write(line)
+					header -= 1
+				else:
+					line = ''
+			# copy by blocks of complete lines
+			while True:
+				block = line + f.read(block_size)
+				line = ''
+				if block == '':
+					break
+				if not block.endswith('\n'):
+					block += f.readline()
+				copy_markdown_block(out, block, recursion, err, deps)
 	except IOError as ex:
 		err.write("IOError when reading: %s\n" % filename)
 		out.write(str(ex))
 		out.write("\n")
 
+def copy_markdown_block(out, block, recursion, err=sys.stderr, deps=None):
+	"""Copies a block of complete lines to the output stream.
+
+	Only the lines containing "![" are searched for included files, the
+	other lines are copied at once.
+	"""
+	copied = 0 # position up to which the block is written
+	pos = block.find('![')
+	while pos >= 0:
+		start = block.rfind('\n', 0, pos) + 1
+		end = block.find('\n', pos) + 1 or len(block)
+		line = block[start:end]
+		pos = block.find('![', end)
+		m = INCLUDE_REGEX.search(line)
+		if m is None or m.group(1).find("://") >= 0:
+			continue
+		ref = m.group(1)
+		ext = os.path.splitext(ref)[1][1:]
+		if ext not in recursion and '' not in recursion:
+			err.write("Included file (as is): %s\n" % ref)
+			if deps is not None:
+				deps.add(ref)
+			continue
+		out.write(block[copied:start + m.start()])
+		recfunc = recursion[ext] if ext in recursion else recursion['']
+		if deps is None:
+			recfunc(out, ref, recursion=recursion, err=err)
+		else:
+			recfunc(out, ref, recursion=recursion, err=err, deps=deps)
+		out.write(line[m.end():])
+		copied = end
+	out.write(block[copied:])
+
 def parse_header(filename):
 	"""Parses the header of a markdown file.
 
@@ -100,26 +166,338 @@ def parse_header(filename):
 					header[m.group(1)] = line
 	return header
 
-def execute(input_files, out=sys.stdout, err=sys.stderr, header=True):
+class FragmentCache(object):
+	"""Size-bounded LRU cache of expanded markdown fragments.
+
+	Entries are keyed by the path of the fragment and the recursion
+	configuration; an entry is valid while none of the expanded files
+	changed (mtime). The expanded texts are stored by content hash, so that
+	identical fragments are stored once. max_size is the total length of the
+	stored texts. The dependencies of each fragment (see copy_markdown) are
+	kept with the entry. The cache can be shared by threads.
+	"""
+
+	def __init__(self, max_size=FRAGMENT_CACHE_SIZE):
+		self.max_size = max_size
+		self.size = 0
+		self.entries = collections.OrderedDict() # key -> (digest, files, deps)
+		self.fragments = {} # digest -> text
+		self.references = collections.Counter() # digest -> entry count
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+	@property
+	def _collecting(self):
+		"""Files of the fragments being expanded by the current thread."""
+		collecting = getattr(self._local, 'collecting', None)
+		if collecting is None:
+			collecting = self._local.collecting = []
+		return collecting
+
+	def copy(self, out, filename, func, config, recursion=None,
+			err=sys.stderr, deps=None):
+		"""Copies a fragment expanded by func (a recursion function)."""
+		try:
+			mtime = os.stat(filename).st_mtime_ns
+		except OSError:
+			if deps is None:
+				return func(out, filename, recursion=recursion, err=err)
+			return func(out, filename, recursion=recursion, err=err,
+				deps=deps)
+		key = (os.path.abspath(filename), config)
+		with self._lock:
+			entry = self.entries.get(key)
+			if entry is not None and self.is_valid(entry[1]):
+				self.hits += 1
+				self.entries.move_to_end(key)
+				text = self.fragments[entry[0]]
+			else:
+				entry = None
+				self.misses += 1
+		if entry is not None:
+			err.write("Cached markdown: %s\n" % filename)
+			self._collect(entry[1])
+			if deps is not None:
+				deps.update(entry[2])
+			out.write(text)
+			return
+		files = {key[0]: mtime}
+		fragment_deps = set()
+		text = io.StringIO()
+		self._collecting.append(files)
+		try:
+			func(text, filename, recursion=recursion, err=err,
+				deps=fragment_deps)
+		finally:
+			self._collecting.pop()
+		text = text.getvalue()
+		out.write(text)
+		self._collect(files)
+		if deps is not None:
+			deps.update(fragment_deps)
+		self.store(key, text, files, frozenset(fragment_deps))
+
+	@staticmethod
+	def is_valid(files):
+		"""Checks that the files did not change."""
+		try:
+			return all(os.stat(path).st_mtime_ns == mtime
+				for path, mtime in files.items())
+		except OSError:
+			return False
+
+	def store(self, key, text, files, deps=frozenset()):
+		"""Stores an expanded fragment and evicts the oldest ones."""
+		if len(text) > self.max_size: return
+		digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+		with self._lock:
+			self.evict(key)
+			if digest not in self.fragments:
+				self.fragments[digest] = text
+				self.size += len(text)
+			self.references[digest] += 1
+			self.entries[key] = (digest, files, deps)
+			while self.size > self.max_size:
+				self.evict(next(iter(self.entries)))
+
+	def evict(self, key):
+		"""Removes an entry (and its text if it is not shared).
+
+		The lock must be held.
+		"""
+		entry = self.entries.pop(key, None)
+		if entry is None: return
+		digest = entry[0]
+		self.references[digest] -= 1
+		if self.references[digest] <= 0:
+			del self.references[digest]
+			self.size -= len(self.fragments.pop(digest))
+
+	def _collect(self, files):
+		"""Adds files to the fragments being expanded."""
+		for collecting in self._collecting:
+			collecting.update(files)
+
+def cached_recursion(cache, recursion=None):
+	"""Gets the recursion functions using a FragmentCache."""
+	if recursion is None:
+		recursion = RECURSION_FUNCTIONS
+	config = tuple(sorted((ext, getattr(func, '__qualname__', repr(func)))
+		for ext, func in recursion.items()))
+	def cached(func):
+		def copy_cached(out, filename, recursion=None, err=sys.stderr,
+				deps=None):
+			cache.copy(out, filename, func, config,
+				recursion=recursion, err=err, deps=deps)
+		return copy_cached
+	return {ext: cached(func) for ext, func in recursion.items()}
+
+def execute(input_files, out=sys.stdout, err=sys.stderr, header=True,
+		recursion=None, deps=None):
 	"""Executes the copy of markdown files."""
 	for filename in input_files:
-		copy_markdown(out, filename, copy_header=header, err=err)
+		copy_markdown(out, filename, copy_header=header, recursion=recursion,
+			err=err, deps=deps)
 		header = False
 
+def make_escape(path):
+	"""Escapes a file name for a Makefile."""
+	return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+def write_depfile(filename, target, deps, sources=()):
+	"""Writes the dependencies of target as a make fragment (atomically).
+
+	As with gcc -MD -MP, each dependency except the sources gets an empty
+	rule, so that removing a file does not break the build.
+	"""
+	deps = sorted(set(deps) - set([target]))
+	directory = os.path.dirname(filename)
+	if directory:
+		os.makedirs(directory, exist_ok=True)
+	tmp = filename + '.tmp'
+	with open(tmp, 'w') as f:
+		f.write(make_escape(target) + ':')
+		for dep in deps:
+			f.write(' \\\n\t' + make_escape(dep))
+		f.write('\n')
+		for dep in deps:
+			if dep in sources: continue
+			f.write('\n%s:\n' % make_escape(dep))
+	os.replace(tmp, filename)
+
+class QueueWriter(object):
+	"""Output stream putting the written strings in a queue."""
+
+	def __init__(self, chunks):
+		self.chunks = chunks
+
+	def write(self, data):
+		"""Puts data in the queue (blocks while the queue is full)."""
+		if data:
+			self.chunks.put(data)
+
+def execute_pipeline(input_files, prog, out=sys.stdout, err=sys.stderr,
+		header=True, recursion=None, filters=(),
+		buffer_size=PIPE_BUFFER_SIZE, queue_size=PIPE_QUEUE_SIZE,
+		deps=None, stderr=None):
+	"""Executes the copy of markdown files into a sub-process.
+
+	A thread reads the files into a bounded queue, another one feeds the
+	queue to the input of prog while the output of prog is streamed to out.
+	The filters are (regex, replacement) applied to each output line; without
+	filters, the output is copied as bytes when out has a buffer.
+	stderr: file receiving the errors of prog (default: inherited)
+	Returns the exit code of prog, 1 if the files could not be read (prog
+	is then killed, so that it does not convert a truncated document).
+	"""
+	progp = subprocess.Popen(prog, stdin=subprocess.PIPE,
+		stdout=subprocess.PIPE, stderr=stderr, bufsize=buffer_size)
+	chunks = queue.Queue(maxsize=queue_size)
+	errors = []
+	def read():
+		try:
+			execute(input_files, out=QueueWriter(chunks), err=err,
+				header=header, recursion=recursion, deps=deps)
+		except Exception as ex:
+			errors.append(ex)
+			progp.kill()
+		finally:
+			chunks.put(None)
+	def feed():
+		stdin = io.TextIOWrapper(progp.stdin, encoding='utf-8', newline='')
+		broken = False
+		for data in iter(chunks.get, None):
+			if broken: continue # drain the queue to stop the reader
+			try:
+				stdin.write(data)
+			except BrokenPipeError:
+				err.write("Broken pipe: %s\n" % prog[0])
+				broken = True
+		try:
+			stdin.close()
+		except BrokenPipeError:
+			pass
+	threads = [threading.Thread(target=read), threading.Thread(target=feed)]
+	for thread in threads:
+		thread.start()
+	if not filters and hasattr(out, 'buffer'):
+		out.flush()
+		shutil.copyfileobj(progp.stdout, out.buffer, buffer_size)
+	else:
+		for line in io.TextIOWrapper(progp.stdout, encoding='utf-8',
+				newline=''):
+			for regex, replacement in filters:
+				line = regex.sub(replacement, line, count=1)
+			out.write(line)
+	for thread in threads:
+		thread.join()
+	code = progp.wait()
+	if errors:
+		err.write("Error when reading the input: %s\n" % errors[0])
+		return 1
+	return code
+
+def convert_document(root, target, prog=None, header=True, recursion=None,
+		filters=(), buffer_size=PIPE_BUFFER_SIZE, depfile=None):
+	"""Converts a root document into target (see execute_batch).
+
+	BATCH_TARGET is replaced by target in prog and depfile; if prog does
+	not contain it, the output is written to target. The header of the
+	root document is parsed, its "$:" lines extend a copy of prog.
+	Returns (exit code, messages).
+	"""
+	err = io.StringIO()
+	redirect = prog is None or not any(BATCH_TARGET in arg for arg in prog)
+	if prog is not None:
+		prog = [arg.replace(BATCH_TARGET, target) for arg in prog]
+	deps = None if depfile is None else set()
+	try:
+		__main_parse_header(root, err=err, prog=prog)
+		out = open(target, 'w') if redirect else io.StringIO()
+		try:
+			if prog is None:
+				execute([root], out=out, err=err, header=header,
+					recursion=recursion, deps=deps)
+				code = 0
+			else:
+				err.write("Piping output: %s\n" % str(prog))
+				with tempfile.TemporaryFile() as prog_err:
+					code = execute_pipeline([root], prog, out=out, err=err,
+						header=header, recursion=recursion, filters=filters,
+						buffer_size=buffer_size, deps=deps, stderr=prog_err)
+					prog_err.seek(0)
+					err.write(prog_err.read().decode(errors='replace'))
+		finally:
+			out.close()
+		if code == 0 and depfile is not None:
+			write_depfile(depfile.replace(BATCH_TARGET, target), target, deps,
+				sources=[root])
+	except (IOError, OSError) as ex:
+		err.write("%s\n" % ex)
+		code = 1
+	if code != 0 and redirect and os.path.isfile(target):
+		os.remove(target)
+	return code, err.getvalue()
+
+def execute_batch(documents, prog=None, jobs=None, err=sys.stderr,
+		**options):
+	"""Converts (root, target) documents concurrently.
+
+	Up to jobs documents (default: cpu count) are converted at a time, each
+	by its own sub-process; the fragment cache is shared. The messages of a
+	document are written to err once it is converted, so that they are not
+	mixed with those of the others.
+	options: see convert_document
+	Returns the list of the documents which failed.
+	"""
+	failed = []
+	with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+		futures = {pool.submit(convert_document, root, target, prog=prog,
+			**options): (root, target) for root, target in documents}
+		for future in concurrent.futures.as_completed(futures):
+			root, target = futures[future]
+			code, messages = future.result()
+			err.write("== %s -> %s\n%s" % (root, target, messages))
+			if code != 0:
+				err.write("Failed: %s (exit code %d)\n" % (root, code))
+				failed.append((root, target))
+	return failed
+
 def main(out=sys.stdout, err=sys.stderr):
 	"""The main program.
 
-	Usage: [--no-header] [--exec prog] -- input files
+	Usage: [--no-header] [--buffer-size bytes] [--cache-size size]
+	       [--fix-latex] [--depfile file] [--target file]
+	       [--batch] [--jobs n] [--exec prog] -- input files
 
 	--no-header does not output the header
+	--cache-size sets the size of the cache of included fragments (default:
+	none, FRAGMENT_CACHE_SIZE in batch mode where documents share them)
+	--buffer-size sets the size of the buffer of the pipe
+	--fix-latex applies LATEX_FIXES to the output of the sub-process
+	--depfile writes the files read and referenced as a make fragment
+	--target sets the target of the depfile (default: first input as pdf)
 	--exec pipes the output to a sub-process
+	--batch converts pairs of input files: root document, output file
+	(see execute_batch, BATCH_TARGET is replaced in prog and the depfile)
+	--jobs sets the number of documents converted at a time in batch mode
 	"""
 	# Variables
 	prog = None
 	input_files = None
 	header = True
+	buffer_size = PIPE_BUFFER_SIZE
+	cache_size = None
+	filters = []
+	depfile = None
+	target = None
+	batch = False
+	jobs = None
+	args = iter(sys.argv[1:])
 	# Parse arguments
-	for arg in sys.argv[1:]:
+	for arg in args:
 		if arg == '--':
 			input_files = []
 			continue
@@ -135,27 +513,72 @@ def main(out=sys.stdout, err=sys.stderr):
 		if arg == '--no-header':
 			header = False
 			continue
+		if arg == '--buffer-size':
+			buffer_size = int(next(args, buffer_size))
+			continue
+		if arg == '--cache-size':
+			cache_size = int(next(args, 0))
+			continue
+		if arg == '--fix-latex':
+			filters = LATEX_FIXES
+			continue
+		if arg == '--depfile':
+			depfile = next(args, None)
+			continue
+		if arg == '--target':
+			target = next(args, None)
+			continue
+		if arg == '--batch':
+			batch = True
+			continue
+		if arg == '--jobs':
+			jobs = int(next(args, 1))
+			continue
 		input_files = [arg]
 	if input_files is None or len(input_files) == 0:
 		err.write("No input files\n")
 		return
+	if batch:
+		if len(input_files) % 2 != 0:
+			err.write("Batch mode: pairs of root document and output file\n")
+			sys.exit(1)
+		if cache_size is None:
+			cache_size = FRAGMENT_CACHE_SIZE
+		recursion = None
+		if cache_size > 0:
+			recursion = cached_recursion(FragmentCache(cache_size))
+		failed = execute_batch(list(zip(input_files[::2], input_files[1::2])),
+			prog=prog, jobs=jobs, err=err, header=header,
+			recursion=recursion, filters=filters, buffer_size=buffer_size,
+			depfile=depfile)
+		if failed:
+			sys.exit(1)
+		return
 	# Parse the header
 	__main_parse_header(input_files[0], err=err, prog=prog)
 	# Execute
-	wait = None
-	if prog is not None:
+	# (the fragments are streamed unless a cache is asked for)
+	recursion = None
+	if cache_size:
+		recursion = cached_recursion(FragmentCache(cache_size))
+	deps = None if depfile is None else set()
+	if prog is None:
+		execute(input_files, header=header, recursion=recursion, out=out,
+			err=err, deps=deps)
+		code = 0
+	else:
 		err.write("Piping output: %s\n" % str(prog))
-		import io
-		import subprocess
-		progp = subprocess.Popen(prog, stdin=subprocess.PIPE)
-		out = io.TextIOWrapper(progp.stdin)
-		wait = progp
-	execute(input_files, header=header, out=out, err=err)
-	# Wait
-	if wait is not None:
-		err.write("Document transformed\n")
-		out.close()
-		wait.wait()
+		code = execute_pipeline(input_files, prog, out=out, err=err,
+			header=header, recursion=recursion, filters=filters,
+			buffer_size=buffer_size, deps=deps)
+		if code == 0:
+			err.write("Document transformed\n")
+	if depfile is not None and code == 0:
+		if target is None:
+			target = os.path.splitext(input_files[0])[0] + '.pdf'
+		write_depfile(depfile, target, deps, sources=input_files)
+	if code != 0:
+		sys.exit(code)
 
 def __main_parse_header(filename, err, prog):
 	"""Parses the header of a file before execution"""